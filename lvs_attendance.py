@@ -7,8 +7,7 @@ Cecks for student's attendance for a given test or date.
 """
 
 from lvs_module import *
-
-from bs4 import BeautifulSoup
+import hashlib
 
 # Use website names instead of english meaning as it makes it easier to compare with network trace.
 add_url(
@@ -52,23 +51,13 @@ def get_lsl_appr_cols_and_discs(csv_fname):
 # returns dict of group_name : group_id
 @pronote.notimplemented
 def mandatory_get_attendance_classgroups(s):
-    # These requests (r1 to r3) are mandatory as they redirects through a "/vsn.main/main/externalOpen"
-    # with an "extautolog" encrypted parameter.
-    # Without it the important request (in get_attendance_student) fails with 500.
-    r1 = s.post(
-        "https://lyceepaullapie92.la-vie-scolaire.fr/vsn.main/WSMenu/getModuleUrl?mod=ABSENCES&minuteEcartGMTClient=-120"
+    # The "absences" module must be opened, else the important request (in get_student_attendance)
+    # fails with 500.
+    r = module_request(
+        s, "absences", "GET", get_url("attendance_choixClasseEleveStrater")
     )
-    r1.raise_for_status()
-    r2 = s.get(json.loads(r1.text)["location"])  # redirects
-    r2.raise_for_status()
-    r3 = s.get(
-        "https://lyceepaullapie92.la-vie-scolaire.fr/vsn.main/absence/absenceStart?actionEnd=calendrierAbsenceEleve&type=absence&idEleve=&accesDeMenu=true"
-    )  # also mandatory
-    r3.raise_for_status()
-    # End of mandatory requests. No response is used (but auth is done).
-    r = s.get(get_url("attendance_choixClasseEleveStrater"))
     r.raise_for_status()
-    soup = BeautifulSoup(r.text, "html.parser")
+    soup = parse_html_only(r.text, id="chooseMenuForm")
     elems = soup.find_all(id="chooseMenuForm")
     if not elems:
         raise RuntimeError("Unexpected format for attendance index on website")
@@ -91,9 +80,16 @@ def get_all_students_ids(s, classgroup_id):
         "actionEnd": "calendrierAbsenceEleve",
         "controllerEnd": "",
     }
-    r = s.post(get_url("attendance_choixClasseEleve"), data=data)
+    r = module_request(
+        s,
+        "absences",
+        "POST",
+        get_url("attendance_choixClasseEleve"),
+        data=data,
+        idempotent=True,
+    )
     r.raise_for_status()
-    soup = BeautifulSoup(r.text, "html.parser")
+    soup = parse_html_only(r.text, "select", id="idEleve")
     selects = soup.find_all("select", id="idEleve")
     if len(selects) != 1:
         raise RuntimeError(
@@ -109,19 +105,117 @@ def get_all_students_ids(s, classgroup_id):
     return student_ids
 
 
-def get_all_students_class_and_ids(s, classgroups):
+roster_cache_fname = "attendance_roster.json"
+
+# Default time to live of the classgroups in the roster cache, in days.
+roster_cache_ttl = 7
+# Default age under which the cached calendar of a student is used without any request, in hours.
+calendar_cache_max_age = 1
+
+
+# Returns a dict of student_name : (classgroup_id, student_id) containing (at least) the
+# student_names that can be found.
+# Classgroups are read from the roster cache (kept per site and school year) if they are less than
+# ttl days old, and only downloaded while some of student_names are not found.
+def get_students_class_and_ids(s, classgroups, student_names, ttl=roster_cache_ttl):
+    roster_cache = read_cache_json(roster_cache_fname)
+    key = f"{get_base_url()} {get_school_year_s()}"
+    # dict of classgroup_id : {"update_time": float, "students": {student_name: student_id}}
+    cached_classgroups = roster_cache.get(key, {})
+    now = time.time()
+
+    def is_fresh(classgroup_id):
+        return (
+            classgroup_id in cached_classgroups
+            and now - cached_classgroups[classgroup_id]["update_time"] < ttl * 24 * 3600
+        )
+
     student_class_and_ids = {}
     for classgroup_id in classgroups.values():
-        student_class_and_ids.update(get_all_students_ids(s, classgroup_id))
+        if is_fresh(classgroup_id):
+            cached_students = cached_classgroups[classgroup_id]["students"]
+            for student_name, student_id in cached_students.items():
+                student_class_and_ids[student_name] = (classgroup_id, student_id)
+    # Cached classgroups are downloaded last: a missing student can have changed classgroup.
+    classgroup_ids = sorted(classgroups.values(), key=is_fresh)
+    is_updated = False
+    for classgroup_id in classgroup_ids:
+        if all(student_name in student_class_and_ids for student_name in student_names):
+            break
+        student_ids = get_all_students_ids(s, classgroup_id)
+        student_class_and_ids.update(student_ids)
+        cached_classgroups[classgroup_id] = {
+            "update_time": now,
+            "students": {
+                student_name: student_id
+                for student_name, (_, student_id) in student_ids.items()
+            },
+        }
+        is_updated = True
+    if is_updated and ttl > 0:
+        roster_cache[key] = cached_classgroups
+        write_cache_json(roster_cache_fname, roster_cache)
     return student_class_and_ids
 
 
-# Not used.
-# Works by requesting the calendar view for a whole classgroup; unfortunately this only gives the last month.
-# (Would need to iterate over months by requesting "prev month" each time.)
-def get_attendance_for_last_month(attendance_dict, s, classgroup_id):
-    student_names_of_ids = {}
-    attendance_dict = {}
+# Default minimum number of students of a same classgroup to check before using the classgroup
+# calendar (one request per month for the whole classgroup) instead of one request per student
+# (see get_attendances).
+class_calendar_min_students = 6
+
+french_month_names = [
+    "janvier",
+    "février",
+    "mars",
+    "avril",
+    "mai",
+    "juin",
+    "juillet",
+    "août",
+    "septembre",
+    "octobre",
+    "novembre",
+    "décembre",
+]
+
+
+# Returns the list of (month, year) from first_month to last_month (both included).
+def months_between(first_month, last_month):
+    months = []
+    month, year = first_month
+    while (year, month) <= (last_month[1], last_month[0]):
+        months.append((month, year))
+        month += 1
+        if month > 12:
+            month = 1
+            year += 1
+    return months
+
+
+# Returns the (month, year) shown by a calendar table: from its header (month name and year) if
+# found, else the month of most of its dates (the grid can show a few days of the adjacent months).
+# None if the table shows neither.
+def shown_month_of_calendar(table):
+    text = " ".join(table.get_text(" ").split()).lower()
+    m = re.search(r"(" + "|".join(french_month_names) + r") (\d{4})", text)
+    if m:
+        return (french_month_names.index(m.group(1)) + 1, int(m.group(2)))
+    counts = {}
+    for month, year in re.findall(r"\d\d/(\d\d)/(\d\d\d\d)", text):
+        month_tuple = (int(month), int(year))
+        counts[month_tuple] = counts.get(month_tuple, 0) + 1
+    if not counts:
+        return None
+    return max(counts, key=counts.get)
+
+
+# Updates attendance_dict with the calendar view for a whole classgroup, which shows a single month
+# (the current one by default, or month_tuple = (month, year)).
+# Returns the set of student names in the calendar view (with or without absences).
+# Raises RuntimeError if the calendar does not show month_tuple (so that the student calendars are
+# read instead).
+def get_class_attendance_for_month(attendance_dict, s, classgroup_id, month_tuple=None):
+    student_names = set()
     # Re compilation done here for clarity over "speed".
     # DD/MM/YYYY
     date_re = re.compile(r"\d\d/\d\d/\d\d\d\d")
@@ -131,39 +225,87 @@ def get_attendance_for_last_month(attendance_dict, s, classgroup_id):
     data = {
         "idClasse": classgroup_id,
         "clean_resteList": "true",
-        "actionEnd": "calendrierAbsenceEleve",
+        "actionEnd": "calendrierAbsenceClasse",
         "controllerEnd": "",
     }
-    r = s.post(get_url("attendance_calendrierClasse"), data=data)
+    if month_tuple is not None:
+        month, year = month_tuple
+        data["dateCalendrier"] = f"01/{month:02d}/{year}"
+    r = module_request(
+        s,
+        "absences",
+        "POST",
+        get_url("attendance_calendrierClasse"),
+        data=data,
+        idempotent=True,
+    )
     r.raise_for_status()
-    soup = BeautifulSoup(r.text, "html.parser")
+    soup = parse_html_only(r.text, "table", class_="tabCalendrierEleve")
     tables = soup.find_all("table", class_="tabCalendrierEleve")
     if len(tables) != 1:
-        raise RuntimeError("Unexpected format of student calendar view (table tag)")
-    tbodys = tables.find_all("tbody")
+        raise RuntimeError("Unexpected format of class calendar view (table tag)")
+    if month_tuple is not None:
+        shown_month = shown_month_of_calendar(tables[0])
+        if shown_month != (month, year):
+            raise RuntimeError(
+                f"Class calendar does not show the month {month:02d}/{year}"
+            )
+    tbodys = tables[0].find_all("tbody")
     if len(tbodys) != 1:
-        raise RuntimeError("Unexpected format of student calendar view (tbody tag)")
-    trs = tbodys.find_all("tr")
+        raise RuntimeError("Unexpected format of class calendar view (tbody tag)")
+    trs = tbodys[0].find_all("tr")
     for tr in trs:
-        student_name = " ".join(tr.find("th").text.split())
+        th = tr.find("th")
+        if th is None:
+            continue
+        student_name = " ".join(th.text.split())
+        student_names.add(student_name)
         spans = tr.find_all("span", class_="corp")
         for span in spans:
             m = re.search(date_re, span.text)
             if m is None:
                 raise RuntimeError(
-                    "Unexpected format of student calendar view (couldn't find date in cell)"
+                    "Unexpected format of class calendar view (couldn't find date in cell)"
                 )
             date = m.group()
+            # The calendar grid can show a few days of the adjacent months.
+            if month_tuple is not None and date[3:] != f"{month:02d}/{year}":
+                continue
             rest = span.text[m.span()[1] :]
             motive_list = re.findall(motive_re, rest)
             # Update dict
             if not date in attendance_dict:
                 attendance_dict[date] = {}
             attendance_dict[date][student_name] = motive_list
-    return attendance_dict
+    return student_names
+
+
+# Updates attendance_dict by walking the classgroup calendar month by month.
+# Returns the set of student names found in every month.
+def get_class_attendance(attendance_dict, s, classgroup_id, months):
+    student_names = None
+    for month_tuple in months:
+        print(f"Reading class calendar for month {month_tuple[0]:02d}/{month_tuple[1]}")
+        month_names = get_class_attendance_for_month(
+            attendance_dict, s, classgroup_id, month_tuple=month_tuple
+        )
+        if student_names is None:
+            student_names = month_names
+        else:
+            student_names &= month_names
+    if student_names is None:
+        student_names = set()
+    return student_names
 
 
-def get_student_attendance(s, classgroup_id, student_id):
+def get_student_attendance(s, classgroup_id, student_id, headers=None):
+    r = request_student_attendance(s, classgroup_id, student_id, headers=headers)
+    soup = parse_html_only(r.text, "table", class_="tabCalendrierEleve")
+    return soup
+
+
+# Returns the response (with status 304 if headers has validators and the page did not change).
+def request_student_attendance(s, classgroup_id, student_id, headers=None):
     data = {
         "idClasse": classgroup_id,
         "idEleve": student_id,
@@ -172,14 +314,22 @@ def get_student_attendance(s, classgroup_id, student_id):
         "controllerEnd": "",
     }
     # This request redirects (302 into a get with a jwtClaim data)
-    r = s.post(get_url("attendance_calendrierAbsenceEleve"), data=data)
+    r = module_request(
+        s,
+        "absences",
+        "POST",
+        get_url("attendance_calendrierAbsenceEleve"),
+        data=data,
+        headers=headers,
+        idempotent=True,
+    )
     r.raise_for_status()
-    soup = BeautifulSoup(r.text, "html.parser")
-    return soup
+    return r
 
 
-# Updates the attendance_dict
-def parse_student_calendar(attendance_dict, soup, student_name):
+# Returns a dict of date_DD/MM/YYYY : motive_list
+def motives_of_student_calendar(soup):
+    student_motives = {}
     # Re compilation done here for clarity over "speed".
     # DD/MM/YYYY
     date_re = re.compile(r"\d\d/\d\d/\d\d\d\d")
@@ -200,13 +350,68 @@ def parse_student_calendar(attendance_dict, soup, student_name):
             )
         date = m.group()
         rest = span.text[m.span()[1] :]
-        motive_list = re.findall(motive_re, rest)
-        # Update dict
+        student_motives[date] = re.findall(motive_re, rest)
+    return student_motives
+
+
+# Updates the attendance_dict
+def parse_student_calendar(attendance_dict, soup, student_name):
+    merge_student_motives(
+        attendance_dict, motives_of_student_calendar(soup), student_name
+    )
+
+
+def merge_student_motives(attendance_dict, student_motives, student_name):
+    for date, motive_list in student_motives.items():
         if not date in attendance_dict:
             attendance_dict[date] = {}
         attendance_dict[date][student_name] = motive_list
 
 
+calendar_cache_fname = "attendance_calendars.json"
+
+
+# Returns the key of a student in the calendar cache
+def calendar_cache_key(student_id):
+    return f"{get_base_url()} {get_school_year_s()} {student_id}"
+
+
+# Downloads and parses the calendar of a student (in the calling thread, so that with
+# map_with_sessions the parsing of a page overlaps with the download of the others).
+# entry is the calendar cache entry of the student, or None. It is revalidated with the HTTP
+# validators of the website if there are any, else by comparing the hash of the calendar table
+# (which avoids parsing it again).
+# Returns (dict of date_DD/MM/YYYY : motive_list, new cache entry)
+def get_student_motives(s, arg):
+    classgroup_id, student_id, entry = arg
+    headers = {}
+    if entry:
+        if entry.get("etag"):
+            headers["If-None-Match"] = entry["etag"]
+        if entry.get("last_modified"):
+            headers["If-Modified-Since"] = entry["last_modified"]
+    r = request_student_attendance(s, classgroup_id, student_id, headers=headers)
+    if entry and r.status_code == 304:
+        return entry["motives"], dict(entry, update_time=time.time())
+    soup = parse_html_only(r.text, "table", class_="tabCalendrierEleve")
+    tables = soup.find_all("table", class_="tabCalendrierEleve")
+    content_hash = hashlib.sha256(
+        "".join([str(table) for table in tables]).encode()
+    ).hexdigest()
+    if entry and entry.get("hash") == content_hash:
+        student_motives = entry["motives"]
+    else:
+        student_motives = motives_of_student_calendar(soup)
+    new_entry = {
+        "update_time": time.time(),
+        "hash": content_hash,
+        "etag": r.headers.get("ETag"),
+        "last_modified": r.headers.get("Last-Modified"),
+        "motives": student_motives,
+    }
+    return student_motives, new_entry
+
+
 def should_check_grade(grade_s):
     if not is_csv_number(grade_s):
         return True
@@ -380,21 +585,232 @@ def collect_all_necessary_params(
     return student_names_to_check, grades_dict, test_date, group_name, test_name
 
 
+# Returns the list of DD/MM/YYYY strings for a date argument: "DD/MM/YYYY", or a range of days
+# "DD/MM/YYYY-DD/MM/YYYY" (both included).
+def dates_of_date_arg(date_s):
+    try:
+        first_s, _, last_s = date_s.partition("-")
+        first_d = datetime.datetime.strptime(first_s.strip(), "%d/%m/%Y").date()
+        last_d = first_d
+        if last_s:
+            last_d = datetime.datetime.strptime(last_s.strip(), "%d/%m/%Y").date()
+    except ValueError:
+        raise RuntimeError(
+            f"Invalid date {date_s} (format is DD/MM/YYYY or DD/MM/YYYY-DD/MM/YYYY)."
+        )
+    return [
+        (first_d + datetime.timedelta(days=i)).strftime("%d/%m/%Y")
+        for i in range((last_d - first_d).days + 1)
+    ]
+
+
+# Batch version of collect_all_necessary_params, without interactive input.
+# test_names is a list of evaluation names (or ["all"] for all the evaluations of the trimester).
+# If test_names is given, only evaluations on one of the dates are kept (if dates is given).
+# Otherwise, all students of each group are checked for each of the dates.
+# Returns a list of (student_names_to_check, grades_dict, test_date, group_name, test_name), with
+# grades_dict and test_name as None when all students are checked.
+def collect_batch_params(s, group_names, test_names=None, dates=None, trimester=None):
+    params_list = []
+    json_groups = get_groups(s)
+    if test_names and trimester is None:
+        trimester = guess_trimester_from_date()
+        print(
+            f"No trimester provided. Guessed trimester {trimester} from current date."
+        )
+    for group_name in group_names:
+        group_name_web, service_id = match_group_name_in_json(group_name, json_groups)
+        if not test_names:
+            # It should be ok to get grades from trimester=1 every time.
+            json_grades = get_grades(s, service_id, 1)
+            student_names = list(get_student_names_of_ids(json_grades).values())
+            for test_date in dates:
+                params_list.append(
+                    (student_names, None, test_date, group_name_web, None)
+                )
+            continue
+        json_grades = get_grades(s, service_id, trimester)
+        test_id_of_name = {
+            devoir["titre"]: devoir["id"] for devoir in json_grades["evaluations"]
+        }
+        group_test_names = test_names
+        if test_names == ["all"]:
+            group_test_names = list(test_id_of_name.keys())
+        for test_name in group_test_names:
+            if not test_name in test_id_of_name:
+                print(
+                    f"Warning: evaluation {test_name} not found for group {group_name_web}, skipping."
+                )
+                continue
+            test_id = test_id_of_name[test_name]
+            test_date = convert_date_from_ymd(
+                get_date_from_json_ymd(json_grades, test_id)
+            )
+            if dates and not test_date in dates:
+                continue
+            student_names_to_check, grades_dict = get_student_names_to_check_from_json(
+                s, json_grades, test_id
+            )
+            params_list.append(
+                (
+                    student_names_to_check,
+                    grades_dict,
+                    test_date,
+                    group_name_web,
+                    test_name,
+                )
+            )
+    return params_list
+
+
+# Checks attendance for all the params of collect_batch_params at once: each student calendar is
+# read only once. Returns the combined report as a str.
+def get_batch_attendance_report(
+    s,
+    classgroups,
+    params_list,
+    jobs=1,
+    roster_ttl=roster_cache_ttl,
+    calendar_max_age=calendar_cache_max_age,
+    class_calendar_min_students=class_calendar_min_students,
+):
+    all_student_names = []
+    for student_names_to_check, _, _, _, _ in params_list:
+        for student_name in student_names_to_check:
+            if not student_name in all_student_names:
+                all_student_names.append(student_name)
+    attendance_dict, students_not_found = get_attendances(
+        s,
+        classgroups,
+        all_student_names,
+        jobs=jobs,
+        dates=[params[2] for params in params_list],
+        roster_ttl=roster_ttl,
+        calendar_max_age=calendar_max_age,
+        class_calendar_min_students=class_calendar_min_students,
+    )
+    output_strs = []
+    for student_names_to_check, grades_dict, test_date, group_name, test_name in sorted(
+        params_list, key=lambda params: (params[2][6:], params[2][3:5], params[2][:2])
+    ):
+        output_strs.append(
+            output_attendance_sub(
+                attendance_dict,
+                test_date,
+                group_name,
+                test_name,
+                students_not_found=students_not_found,
+                student_names_to_check=student_names_to_check,
+                grades_dict=grades_dict,
+            )
+        )
+    return "\n".join([output_s.rstrip("\n") + "\n" for output_s in output_strs])
+
+
 # Returns (attendance_dict, students_not_found, test_date)
 # attendance_dict is a dict of date_DD/MM/YYYY : dict of student_name : motive_list
 # students_not_found is a set of student names
-def get_attendances(s, classgroups, student_names_to_check):
+# dates is a list of DD/MM/YYYY strings. If given, only the attendance for these dates is needed,
+# and students of a same classgroup are read from the classgroup calendar when there are at least
+# class_calendar_min_students of them (0 or None to always read the student calendars).
+# roster_ttl is the time to live of the roster cache in days (see get_students_class_and_ids).
+# Student calendars are kept in a cache. They are used without any request if they are less than
+# calendar_max_age hours old, else they are revalidated (see get_student_motives).
+def get_attendances(
+    s,
+    classgroups,
+    student_names_to_check,
+    jobs=1,
+    dates=None,
+    roster_ttl=roster_cache_ttl,
+    calendar_max_age=calendar_cache_max_age,
+    class_calendar_min_students=class_calendar_min_students,
+):
     attendance_dict = {}
     students_not_found = []
-    student_class_and_ids = get_all_students_class_and_ids(s, classgroups)
+    student_class_and_ids = get_students_class_and_ids(
+        s, classgroups, student_names_to_check, ttl=roster_ttl
+    )
+    student_names_found = []
     for student_name in student_names_to_check:
         if not student_name in student_class_and_ids:
             students_not_found.append(student_name)
         else:
-            classgroup_id, student_id = student_class_and_ids[student_name]
-            print("Reading calendar for student", student_name)
-            soup = get_student_attendance(s, classgroup_id, student_id)
-            parse_student_calendar(attendance_dict, soup, student_name)
+            student_names_found.append(student_name)
+    date_months = []
+    for date in dates or []:
+        try:
+            d = datetime.datetime.strptime(date, "%d/%m/%Y")
+        except (TypeError, ValueError):
+            continue
+        date_months.append((d.month, d.year))
+    if date_months and class_calendar_min_students:
+        months = months_between(
+            min(date_months, key=lambda m: m[::-1]),
+            max(date_months, key=lambda m: m[::-1]),
+        )
+        student_names_of_classgroup = {}
+        for student_name in student_names_found:
+            classgroup_id = student_class_and_ids[student_name][0]
+            student_names_of_classgroup.setdefault(classgroup_id, []).append(
+                student_name
+            )
+        for classgroup_id, student_names in student_names_of_classgroup.items():
+            if len(student_names) < class_calendar_min_students:
+                continue
+            try:
+                class_student_names = get_class_attendance(
+                    attendance_dict, s, classgroup_id, months
+                )
+            except (RuntimeError, requests.exceptions.HTTPError) as e:
+                print(
+                    f"Warning: could not read the class calendar ({e}), reading student calendars instead."
+                )
+                continue
+            # Students missing from the class calendar are still read one by one.
+            student_names_found = [
+                student_name
+                for student_name in student_names_found
+                if not student_name in class_student_names
+            ]
+    calendar_cache = read_cache_json(calendar_cache_fname)
+    cache_key_of_name = {
+        student_name: calendar_cache_key(student_class_and_ids[student_name][1])
+        for student_name in student_names_found
+    }
+    student_names_to_download = []
+    for student_name in student_names_found:
+        entry = calendar_cache.get(cache_key_of_name[student_name])
+        if entry and time.time() - entry["update_time"] < calendar_max_age * 3600:
+            print("Using cached calendar for student", student_name)
+            merge_student_motives(attendance_dict, entry["motives"], student_name)
+        else:
+            student_names_to_download.append(student_name)
+    # With jobs > 1, calendars are downloaded concurrently but still merged in the same order.
+    results = map_with_sessions(
+        s,
+        get_student_motives,
+        [
+            student_class_and_ids[student_name]
+            + (calendar_cache.get(cache_key_of_name[student_name]),)
+            for student_name in student_names_to_download
+        ],
+        jobs=jobs,
+    )
+    for student_name, (student_motives, entry) in zip(
+        student_names_to_download, results
+    ):
+        print("Read calendar for student", student_name)
+        merge_student_motives(attendance_dict, student_motives, student_name)
+        calendar_cache[cache_key_of_name[student_name]] = entry
+    if student_names_to_download:
+        # Entries of past school years are not needed anymore
+        calendar_cache = {
+            key: entry
+            for key, entry in calendar_cache.items()
+            if time.time() - entry["update_time"] < 365 * 24 * 3600
+        }
+        write_cache_json(calendar_cache_fname, calendar_cache)
     if students_not_found:
         print(
             f"Warning: The following students were not on the attendance lists: {nicer_str(students_not_found)}"
@@ -465,6 +881,10 @@ def output_attendance(
         student_names_to_check=student_names_to_check,
         grades_dict=grades_dict,
     )
+    output_attendance_s(output_s, output_file=output_file)
+
+
+def output_attendance_s(output_s, output_file=None):
     if output_file is None or output_file == "":
         print(
             "\n" + output_s
@@ -537,6 +957,68 @@ def main():
                     "help": "Write attendance to this file instead of standard output.",
                 },
             ),
+            (
+                ("--evaluations",),
+                {
+                    "metavar": "EVAL",
+                    "nargs": "+",
+                    "help": 'Batch mode: check attendance for each of these evaluations (tests), for each group of --groups. "all" stands for all the evaluations of the trimester. Grades are taken from the website, and the report contains all the evaluations.',
+                },
+            ),
+            (
+                ("--groups",),
+                {
+                    "metavar": "GROUP",
+                    "nargs": "+",
+                    "help": "Batch mode: the groups to check. Default is the group given by -g.",
+                },
+            ),
+            (
+                ("--dates",),
+                {
+                    "metavar": "DATE",
+                    "nargs": "+",
+                    "help": "Batch mode: dates to check, as DD/MM/YYYY or ranges DD/MM/YYYY-DD/MM/YYYY. Without --evaluations, all students of the groups are checked for each date. With --evaluations, only the evaluations on these dates are kept.",
+                },
+            ),
+            (
+                ("--roster-ttl",),
+                {
+                    "metavar": "DAYS",
+                    "type": float,
+                    "default": roster_cache_ttl,
+                    "help": f"Use the cached list of students of each class if it is less than DAYS days old. 0 disables the cache. Default is {roster_cache_ttl}.",
+                },
+            ),
+            (
+                ("--calendar-max-age",),
+                {
+                    "metavar": "HOURS",
+                    "type": float,
+                    "default": calendar_cache_max_age,
+                    "help": f"Use the cached calendar of a student without checking the website if it is less than HOURS hours old. 0 always checks (which is still faster than reading the calendar again when it did not change). Default is {calendar_cache_max_age}.",
+                },
+            ),
+            (
+                ("--jobs",),
+                {
+                    "metavar": "N",
+                    "type": int,
+                    "default": 1,
+                    "help": "Number of student calendars to download at the same time. Default is 1 (one student after the other).",
+                },
+            ),
+            (
+                ("--class-calendar",),
+                {
+                    "metavar": "MIN_STUDENTS",
+                    "type": int,
+                    "nargs": "?",
+                    "const": class_calendar_min_students,
+                    "default": class_calendar_min_students,
+                    "help": f"Read the calendar of a whole class (one request per month) instead of the calendar of each student, for the classes with at least MIN_STUDENTS students to check. The student calendars are still read if the class calendar does not show the expected month. 0 always reads the student calendars. Default is {class_calendar_min_students}.",
+                },
+            ),
         ]
         shared_args = ["group", "trimester"]
         # Set dont_process="csv_fname" because we do more than the default processing here.
@@ -550,6 +1032,39 @@ def main():
         )
         s = open_session_from_args(args)
         classgroups = mandatory_get_attendance_classgroups(s)
+        if args["evaluations"] or args["groups"] or args["dates"]:
+            group_names = args["groups"]
+            if not group_names and args["group_name"]:
+                group_names = [args["group_name"]]
+            if not group_names:
+                raise RuntimeError("Batch mode: no group provided (use --groups).")
+            dates = None
+            if args["dates"] or args["test_date"]:
+                dates = []
+                for date_s in args["dates"] or [args["test_date"]]:
+                    dates += dates_of_date_arg(date_s)
+            if not (args["evaluations"] or dates):
+                raise RuntimeError(
+                    "Batch mode: no evaluation nor date provided (use --evaluations or --dates)."
+                )
+            params_list = collect_batch_params(
+                s,
+                group_names,
+                test_names=args["evaluations"],
+                dates=dates,
+                trimester=args["trimester"],
+            )
+            output_s = get_batch_attendance_report(
+                s,
+                classgroups,
+                params_list,
+                jobs=args["jobs"],
+                roster_ttl=args["roster_ttl"],
+                calendar_max_age=args["calendar_max_age"],
+                class_calendar_min_students=args["class_calendar"],
+            )
+            output_attendance_s(output_s, output_file=args["output_file"])
+            return
         params = collect_all_necessary_params(
             s,
             classgroups,
@@ -562,7 +1077,14 @@ def main():
         )
         student_names_to_check, grades_dict, test_date, group_name, test_name = params
         attendance_dict, students_not_found = get_attendances(
-            s, classgroups, student_names_to_check
+            s,
+            classgroups,
+            student_names_to_check,
+            jobs=args["jobs"],
+            dates=[test_date],
+            roster_ttl=args["roster_ttl"],
+            calendar_max_age=args["calendar_max_age"],
+            class_calendar_min_students=args["class_calendar"],
         )
         output_attendance(
             attendance_dict,
@@ -8,18 +8,34 @@ Downloads the time schedule for each room then displays the ones which are free
 
 from lvs_module import *
 
-from bs4 import BeautifulSoup
 import pickle
+import sqlite3
+import bisect
+import http.server
+import urllib.parse
+import io
+
+try:
+    import numpy as np
+except ImportError:
+    # Optional. Without numpy, free rooms are found with the interval index only.
+    np = None
 
 add_url("room", "/vsn.main/temps/salle")
 add_url("select_date", "/vsn.main/temps/semaineDate")
 
 
 def get_room_ids(s):
+    return response_cache.cached_read(
+        get_cache_scope(s), "room", None, lambda: request_room_ids(s)
+    )
+
+
+def request_room_ids(s):
     url = get_url("room")
     r = s.get(url)
     r.raise_for_status()
-    soup = BeautifulSoup(r.text, "html.parser")
+    soup = parse_html_only(r.text, "select", id="idSalle")
     rooms = {}
     try:
         sel = soup.find_all("select", id="idSalle")[0]
@@ -37,9 +53,9 @@ def get_room_ids(s):
 def get_time_schedule(s, room_id):
     url = get_url("room")
     params = {"idSalle": str(room_id)}
-    r = s.post(url, params=params)
+    r = s.post(url, params=params, idempotent=True)
     r.raise_for_status()
-    soup = BeautifulSoup(r.text, "html.parser")
+    soup = parse_html_only(r.text, "div", id="infosCoursEleve")
     date_regex = r"Cours du \w+ (\d{2}) (\w+) (\d{4})"
     month_list = [
         "janvier",
@@ -78,17 +94,25 @@ def get_time_schedule(s, room_id):
 
 
 # time_slots is a dict of day : { slot : room_name_list }
-def get_all_time_slots(s, rooms, excluded=set()):
+# With jobs > 1, the schedules are downloaded concurrently (the output order stays the same).
+# If room_schedules is a dict, it is updated with the same data organized by room, as a dict of
+# day : { room_name : sorted slot list } (only rooms with at least one slot that day are present).
+def get_all_time_slots(s, rooms, excluded=set(), jobs=1, room_schedules=None):
     # Get time schedule for each room
     time_slots = {}
     always_free = set()
     print("Downloading room schedules")
-    for room_name, room_id in rooms.items():
-        if room_name in excluded:
-            continue
+    room_items = [
+        (room_name, room_id)
+        for room_name, room_id in rooms.items()
+        if not room_name in excluded
+    ]
+    schedule_lists = map_with_sessions(
+        s, get_time_schedule, [room_id for room_name, room_id in room_items], jobs=jobs
+    )
+    for (room_name, room_id), schedule_list in zip(room_items, schedule_lists):
         # flush=True to use this output as a kind of progress bar.
         print(room_name, end=" ", flush=True)
-        schedule_list = get_time_schedule(s, room_id)
         if not schedule_list:
             always_free.add(room_name)
         for date_tuple, slot in schedule_list:
@@ -97,6 +121,13 @@ def get_all_time_slots(s, rooms, excluded=set()):
             if not slot in time_slots[date_tuple]:
                 time_slots[date_tuple][slot] = set()
             time_slots[date_tuple][slot].add(room_name)
+            if room_schedules is not None:
+                day_schedules = room_schedules.setdefault(date_tuple, {})
+                day_schedules.setdefault(room_name, []).append(slot)
+    if room_schedules is not None:
+        for day_schedules in room_schedules.values():
+            for schedule in day_schedules.values():
+                schedule.sort()
     # Empty line
     print()
     always_free = list(always_free)
@@ -155,7 +186,7 @@ def request_date_change(s, date_tuple):
     day, month, year = date_tuple
     url = get_url("select_date")
     params = {"dateSemaine": f"{day:02d}/{month:02d}/{year}"}
-    r = s.post(url, params=params)
+    r = s.post(url, params=params, idempotent=True)
     r.raise_for_status()
 
 
@@ -198,48 +229,110 @@ def guess_base_time_slots(time_slots):
     return base_slots
 
 
+def minutes_of_tt(tt):
+    return tt[0] * 60 + tt[1]
+
+
+# Interval index for the slots of one day, built once from time_slots[date_tuple].
+# Slots are sorted by start time (in minutes). Since no slot is longer than max_length, the slots
+# overlapping [start, end) are among those starting in (start - max_length, end), found by bisection.
+# Returns a dict with keys:
+#   "starts": sorted list of slot start times (in minutes)
+#   "slots": list of (start, end, slot, room_names), in the same order as "starts"
+#   "ends": sorted list of distinct slot end times (as time tuples)
+#   "max_length": length of the longest slot (in minutes)
+def build_day_index(day_slots):
+    slots = []
+    for slot, room_names in day_slots.items():
+        slots.append(
+            (
+                minutes_of_tt(slot[0]),
+                minutes_of_tt(slot[1]),
+                slot,
+                frozenset(room_names),
+            )
+        )
+    slots.sort(key=lambda e: (e[0], e[1]))
+    return {
+        "starts": [e[0] for e in slots],
+        "slots": slots,
+        "ends": sorted({slot[1] for slot in day_slots}),
+        "max_length": max([e[1] - e[0] for e in slots], default=0),
+    }
+
+
+# Returns a dict of date_tuple : day index (see build_day_index)
+def build_time_slots_index(time_slots):
+    return {d: build_day_index(time_slots[d]) for d in time_slots}
+
+
+# Returns the set of rooms busy at some point during [start_tt, end_tt)
+def busy_rooms_in_slot(day_index, start_tt, end_tt):
+    start_m, end_m = minutes_of_tt(start_tt), minutes_of_tt(end_tt)
+    starts = day_index["starts"]
+    lo = bisect.bisect_left(starts, start_m - day_index["max_length"])
+    hi = bisect.bisect_left(starts, end_m)
+    busy = set()
+    for slot_start, slot_end, slot, room_names in day_index["slots"][lo:hi]:
+        # Same (strict) inequalities as in overlap().
+        if start_m < slot_end or start_m <= slot_start:
+            busy.update(room_names)
+    return busy
+
+
+# Returns the sorted list of the slot end times strictly between start_tt and last_tt
+def slot_ends_between(day_index, start_tt, last_tt):
+    ends = day_index["ends"]
+    lo = bisect.bisect_right(ends, start_tt)
+    hi = bisect.bisect_left(ends, last_tt)
+    return ends[lo:hi]
+
+
 # Returns a free room set
 # Defaults to a 21m duration (should avoid any recess time slots of <= 20m)
-def find_free_rooms_sub(time_slots, rooms, date_tuple, start_tt, duration=21):
+# The day_index can be given to avoid rebuilding it (see build_day_index).
+def find_free_rooms_sub(
+    time_slots, rooms, date_tuple, start_tt, duration=21, day_index=None
+):
     duration = max(0, int(duration))
     assert date_tuple in time_slots
+    if day_index is None:
+        day_index = build_day_index(time_slots[date_tuple])
     end_tt = add_tt(start_tt, (0, duration))
-    requested_slot = (start_tt, end_tt)
-    # Get all time slots that overlap the requested slot
-    relevant_slots = set()
-    for slot in time_slots[date_tuple].keys():
-        if overlap(slot, requested_slot):
-            relevant_slots.add(slot)
     # Get all free rooms at that slot (by elimination)
-    free_rooms = set(rooms.keys())
-    for slot in relevant_slots:
-        free_rooms -= set(time_slots[date_tuple][slot])
-    return free_rooms
+    return rooms.keys() - busy_rooms_in_slot(day_index, start_tt, end_tt)
 
 
 # Returns a dict of start_tt : free room set
 # The max_delay is how patient the user is (in minutes).
 def find_free_rooms(
-    time_slots, rooms, date_tuple, start_tt, excluded=set(), duration=21, max_delay=30
+    time_slots,
+    rooms,
+    date_tuple,
+    start_tt,
+    excluded=set(),
+    duration=21,
+    max_delay=30,
+    day_index=None,
 ):
+    if day_index is None:
+        day_index = build_day_index(time_slots[date_tuple])
     # Get possible starting times when the room we are looking for is free (from now to delay).
-    possible_starts = {start_tt}
     last_start_tt = add_tt(start_tt, (0, max_delay))
     # Get those that will soon be free (looking at time slots that end soon and might free a room).
-    for slot in time_slots[date_tuple]:
-        slot_end = slot[1]
-        if start_tt < slot_end < last_start_tt:
-            possible_starts.add(slot_end)
-    possible_starts = list(possible_starts)
-    possible_starts.sort()
+    possible_starts = [start_tt] + slot_ends_between(day_index, start_tt, last_start_tt)
     # Find rooms starting at those possible times
     free_rooms_by_start = {}
     for tt in possible_starts:
         free_rooms_by_start[tt] = find_free_rooms_sub(
-            time_slots, rooms, date_tuple, tt, duration=duration
+            time_slots, rooms, date_tuple, tt, duration=duration, day_index=day_index
         )
-    # Return a pruned version that skips the rooms already free at the previous time
-    # (of the unpruned version, to still show rooms that are occupied then free again)
+    return prune_free_rooms_by_start(possible_starts, free_rooms_by_start, excluded)
+
+
+# Returns a pruned version of free_rooms_by_start that skips the rooms already free at the previous time
+# (of the unpruned version, to still show rooms that are occupied then free again)
+def prune_free_rooms_by_start(possible_starts, free_rooms_by_start, excluded=set()):
     pruned = {}
     prev_tt = None
     for tt in possible_starts:
@@ -253,6 +346,169 @@ def find_free_rooms(
     return pruned
 
 
+## Occupancy matrix engine (needs numpy).
+# An "occupancy" is a dict with keys:
+#   "room_names": sorted list of room names
+#   "matrix": boolean numpy array with one row per room (same order) and one column per minute
+#             of the day, True when the room is busy.
+#   "ends": sorted list of the distinct slot end times, in minutes (back to back slots of a room
+#           cannot be told apart in the matrix, and those ends are possible start times).
+# A slot (start, end) marks the minutes from start to end excluded. A zero length slot marks one minute.
+
+minutes_per_day = 24 * 60
+
+
+def tt_of_minutes(m):
+    return (int(m) // 60, int(m) % 60)
+
+
+def build_occupancy(day_slots, rooms):
+    room_names = sorted(rooms)
+    row_of_room = {room_name: i for i, room_name in enumerate(room_names)}
+    matrix = np.zeros((len(room_names), minutes_per_day), dtype=bool)
+    for slot, slot_rooms in day_slots.items():
+        start_m = minutes_of_tt(slot[0])
+        end_m = max(minutes_of_tt(slot[1]), start_m + 1)
+        rows = [
+            row_of_room[room_name]
+            for room_name in slot_rooms
+            if room_name in row_of_room
+        ]
+        matrix[rows, start_m:end_m] = True
+    ends = sorted({minutes_of_tt(slot[1]) for slot in day_slots})
+    return {"room_names": room_names, "matrix": matrix, "ends": ends}
+
+
+# Returns a dict of date_tuple : occupancy
+def build_occupancies(time_slots, rooms):
+    return {d: build_occupancy(time_slots[d], rooms) for d in time_slots}
+
+
+# Bit-packed version of an occupancy, as plain bytes (as stored in the data file).
+def pack_occupancy(occupancy):
+    return {
+        "room_names": occupancy["room_names"],
+        "bits": np.packbits(occupancy["matrix"], axis=1).tobytes(),
+        "ends": occupancy["ends"],
+    }
+
+
+def unpack_occupancy(packed):
+    room_names = packed["room_names"]
+    bits = np.frombuffer(packed["bits"], dtype=np.uint8).reshape(len(room_names), -1)
+    matrix = np.unpackbits(bits, axis=1, count=minutes_per_day).astype(bool)
+    return {"room_names": room_names, "matrix": matrix, "ends": packed["ends"]}
+
+
+# Returns a boolean array with the shape of the matrix: True where the room is free for
+# duration minutes starting at that minute. Sliding window sum over all rooms at once.
+def free_windows(matrix, duration):
+    busy_counts = np.zeros((matrix.shape[0], matrix.shape[1] + 1), dtype=np.int32)
+    np.cumsum(matrix, axis=1, out=busy_counts[:, 1:])
+    window_ends = np.minimum(np.arange(matrix.shape[1]) + duration, matrix.shape[1])
+    return busy_counts[:, window_ends] - busy_counts[:, :-1] == 0
+
+
+# Same as find_free_rooms, using an occupancy.
+# Rooms of the occupancy are all the rooms (there is no "rooms" argument).
+# The duration must be > 0 (a window of 0 minutes is always free).
+def find_free_rooms_occupancy(
+    occupancy, start_tt, excluded=set(), duration=21, max_delay=30, windows=None
+):
+    matrix = occupancy["matrix"]
+    room_names = occupancy["room_names"]
+    duration = max(1, int(duration))
+    if windows is None:
+        windows = free_windows(matrix, duration)
+    start_m = minutes_of_tt(start_tt)
+    last_start_m = start_m + max_delay
+    # Get those that will soon be free (slots that end soon and might free a room).
+    ends = occupancy["ends"]
+    possible_starts = [start_m] + ends[
+        bisect.bisect_right(ends, start_m) : bisect.bisect_left(ends, last_start_m)
+    ]
+    free_rooms_by_start = {}
+    for m in possible_starts:
+        free_rooms_by_start[tt_of_minutes(m)] = {
+            room_names[i] for i in np.flatnonzero(windows[:, m])
+        }
+    possible_starts = [tt_of_minutes(m) for m in possible_starts]
+    return prune_free_rooms_by_start(possible_starts, free_rooms_by_start, excluded)
+
+
+# Returns a dict of room_name : (free_start, free_end), the longest free slot around start_tt
+# for each room, bounded by whole_day (same result as the loop over room_schedule in
+# get_free_slot_rooms).
+# A zero length slot (s, s) marks the minute s busy, so that the free rooms are the same as with
+# overlap(), but the free slot after it starts at s (not s + 1): room_schedule is used to check
+# these slots, if given.
+def free_slots_of_occupancy(occupancy, start_tt, whole_day, room_schedule=None):
+    matrix = occupancy["matrix"]
+    start_m = minutes_of_tt(start_tt)
+    # The s of a zero length slot is also a slot end.
+    end_set = set(occupancy["ends"])
+    before = matrix[:, :start_m]
+    after = matrix[:, start_m:]
+    free_slots = {}
+    has_before = before.any(axis=1) if start_m > 0 else np.zeros(len(matrix), bool)
+    has_after = after.any(axis=1)
+    # Offset of the last busy minute before start_tt, and of the first busy minute after.
+    last_before = np.argmax(before[:, ::-1], axis=1) if start_m > 0 else has_before
+    first_after = np.argmax(after, axis=1)
+    for i, room_name in enumerate(occupancy["room_names"]):
+        free_start, free_end = whole_day
+        if has_before[i]:
+            free_start_m = start_m - last_before[i]
+            if room_schedule is not None and free_start_m - 1 in end_set:
+                point_tt = tt_of_minutes(free_start_m - 1)
+                schedule = room_schedule.get(room_name, [])
+                if (point_tt, point_tt) in schedule and not any(
+                    slot[1] == tt_of_minutes(free_start_m) for slot in schedule
+                ):
+                    free_start_m -= 1
+            free_start = max(free_start, tt_of_minutes(free_start_m))
+        if has_after[i]:
+            free_end = min(free_end, tt_of_minutes(start_m + first_after[i]))
+        free_slots[room_name] = (free_start, free_end)
+    return free_slots
+
+
+# Returns a list of (free_slot, room_name), the longest free slot around start_tt of each room
+# of free_rooms, sorted with the rooms free for the longest time first.
+# Uses the occupancy if given, otherwise the room_schedule (a dict of room_name : sorted slot list).
+def get_free_slot_rooms(
+    free_rooms, start_tt, whole_day, room_schedule=None, occupancy=None
+):
+    if occupancy is not None:
+        # Same result as the loop below, computed for all rooms at once.
+        free_slots = free_slots_of_occupancy(
+            occupancy, start_tt, whole_day, room_schedule=room_schedule
+        )
+    else:
+        free_slots = {}
+        for room_name in free_rooms:
+            # Maximal free time slot
+            free_start, free_end = whole_day
+            # Get actual free time slot starting at start_tt
+            for slot in room_schedule[room_name]:
+                # slot ends before now; at best the free slot starts after that
+                if free_start <= slot[1] <= start_tt:
+                    free_start = slot[1]
+                # slot starts after now; at best the free slot ends before that
+                if free_end >= slot[0] >= start_tt:
+                    free_end = slot[0]
+            free_slots[room_name] = (free_start, free_end)
+    free_slot_rooms = [(free_slots[room_name], room_name) for room_name in free_rooms]
+    # Multiple sorts to make it a total order
+    # Sort alphabetically first (least important)
+    free_slot_rooms.sort(key=lambda p: p[1])
+    # Then by start time
+    free_slot_rooms.sort(key=lambda p: p[0][0])
+    # Sort with latest end_time in first place (most time left from now)
+    free_slot_rooms.sort(reverse=True, key=lambda p: p[0][1])
+    return free_slot_rooms
+
+
 # Returns a string with, the longest free slot for each room around the start time.
 # Goes through each start time in order.
 def s_of_free_rooms(
@@ -262,6 +518,7 @@ def s_of_free_rooms(
     whole_day,
     are_all_free,
     always_free=[],
+    occupancy=None,
 ):
     r = ""
     first_it = True
@@ -272,28 +529,15 @@ def s_of_free_rooms(
             first_it = False
         else:
             r += f"\nRooms (soon) free {start_s}:\n"
-        free_slot_rooms = []
-        for room_name in free_rooms_by_start[start_tt]:
-            # Maximal free time slot
-            free_start, free_end = whole_day
-            # Get actual free time slot starting at start_tt
-            for slot in room_schedule[room_name]:
-                # slot ends before now; at best the free slot starts after that
-                if free_start <= slot[1] <= start_tt:
-                    free_start = slot[1]
-                # slot starts after now; at best the free slot ends before that
-                if free_end >= slot[0] >= start_tt:
-                    free_end = slot[0]
-            free_slot_rooms.append(((free_start, free_end), room_name))
+        free_slot_rooms = get_free_slot_rooms(
+            free_rooms_by_start[start_tt],
+            start_tt,
+            whole_day,
+            room_schedule=room_schedule,
+            occupancy=occupancy,
+        )
         if are_all_free:
             r += "(All rooms are free at that time.)\n"
-        # Multiple sorts to make it a total order
-        # Sort alphabetically first (least important)
-        free_slot_rooms.sort(key=lambda p: p[1])
-        # Then by start time
-        free_slot_rooms.sort(key=lambda p: p[0][0])
-        # Sort with latest end_time in first place (most time left from now)
-        free_slot_rooms.sort(reverse=True, key=lambda p: p[0][1])
         char_nb = max([len(room_name) for slot, room_name in free_slot_rooms])
         for slot, room_name in free_slot_rooms:
             r += f"{room_name.ljust(char_nb)}   {s_of_slot(slot, whole_day)}\n"
@@ -303,25 +547,12 @@ def s_of_free_rooms(
     return r
 
 
-def save_time_slots(fname, time_slots, always_free, update_times, rooms):
-    curr_d = datetime.datetime.now()
-    curr_d_str = curr_d.strftime("%d/%m/%Y at %H:%M")
-    for d in time_slots.keys():
-        if not d in update_times:
-            update_times[d] = curr_d_str
-    data = {
-        "time_slots": time_slots,
-        "always_free": always_free,
-        "update_times": update_times,
-        "rooms": rooms,
-    }
-    print(f"Writing data to file {fname}")
-    with open(fname, "wb") as f:
-        pickle.dump(data, f)
-
-
+# Reads a file written by older versions (a pickle of the whole data). See the SQLite store below.
 # Updates the dicts.
-def load_time_slots(fname, time_slots, always_free, update_times, rooms):
+# If occupancies is a dict, it is also updated with the occupancy matrices saved in the file (if any).
+def load_time_slots(
+    fname, time_slots, always_free, update_times, rooms, occupancies=None
+):
     print(f"Loading data from {fname}")
     try:
         with open(fname, "rb") as f:
@@ -341,6 +572,350 @@ def load_time_slots(fname, time_slots, always_free, update_times, rooms):
     rooms.update(d)
     for room in b:
         always_free.remove(room)
+    if occupancies is not None and np is not None:
+        for d, packed in data.get("occupancies", {}).items():
+            occupancies[d] = unpack_occupancy(packed)
+
+
+## SQLite store for the downloaded data.
+# The data is indexed by date, so that a query only reads the requested day, and saving only
+# writes the days that were just downloaded.
+# Slot times are stored in minutes, dates as YYYY-MM-DD (so that they can be compared).
+
+store_schema = """
+CREATE TABLE IF NOT EXISTS slots (
+    date TEXT, room TEXT, start_m INTEGER, end_m INTEGER,
+    PRIMARY KEY (date, room, start_m, end_m)
+);
+CREATE TABLE IF NOT EXISTS dates (date TEXT PRIMARY KEY, update_time TEXT);
+CREATE TABLE IF NOT EXISTS rooms (room TEXT PRIMARY KEY, room_id TEXT, always_free INTEGER);
+CREATE TABLE IF NOT EXISTS occupancies (
+    date TEXT PRIMARY KEY, room_names TEXT, bits BLOB, ends TEXT
+);
+"""
+
+
+def iso_of_date_tuple(date_tuple):
+    day, month, year = date_tuple
+    return f"{year:04d}-{month:02d}-{day:02d}"
+
+
+def date_tuple_of_iso(date_iso):
+    year, month, day = [int(x) for x in date_iso.split("-")]
+    return day, month, year
+
+
+# Files written by older versions are pickles. An empty file is a valid (empty) SQLite store.
+def is_pickle_file(fname):
+    with open(fname, "rb") as f:
+        header = f.read(16)
+    return bool(header) and header != b"SQLite format 3\x00"
+
+
+def open_store(fname):
+    try:
+        con = sqlite3.connect(fname)
+        con.executescript(store_schema)
+    except sqlite3.DatabaseError as e:
+        raise RuntimeError(
+            f"Error opening data file {fname}. This file must be empty or contain data created by this program.\n{e}"
+        )
+    return con
+
+
+# Writes the data of the dates in time_slots, replacing what was stored for those dates only.
+# The room list is replaced if rooms is not empty.
+def store_time_slots(fname, time_slots, always_free, update_times, rooms):
+    curr_d = datetime.datetime.now()
+    curr_d_str = curr_d.strftime("%d/%m/%Y at %H:%M")
+    print(f"Writing data to file {fname}")
+    con = open_store(fname)
+    try:
+        # One transaction for the whole update.
+        with con:
+            for d in time_slots:
+                date_iso = iso_of_date_tuple(d)
+                con.execute("DELETE FROM slots WHERE date = ?", (date_iso,))
+                con.executemany(
+                    "INSERT OR IGNORE INTO slots VALUES (?, ?, ?, ?)",
+                    [
+                        (
+                            date_iso,
+                            room_name,
+                            minutes_of_tt(slot[0]),
+                            minutes_of_tt(slot[1]),
+                        )
+                        for slot, room_names in time_slots[d].items()
+                        for room_name in room_names
+                    ],
+                )
+                con.execute(
+                    "INSERT OR REPLACE INTO dates VALUES (?, ?)",
+                    (date_iso, update_times.get(d, curr_d_str)),
+                )
+                if np is not None:
+                    packed = pack_occupancy(build_occupancy(time_slots[d], rooms))
+                    con.execute(
+                        "INSERT OR REPLACE INTO occupancies VALUES (?, ?, ?, ?)",
+                        (
+                            date_iso,
+                            json.dumps(packed["room_names"]),
+                            packed["bits"],
+                            json.dumps(packed["ends"]),
+                        ),
+                    )
+            if rooms:
+                con.execute("DELETE FROM rooms")
+                con.executemany(
+                    "INSERT INTO rooms VALUES (?, ?, ?)",
+                    [
+                        (room_name, room_id, room_name in always_free)
+                        for room_name, room_id in rooms.items()
+                    ],
+                )
+    finally:
+        con.close()
+
+
+# Same as load_time_slots, for the SQLite store.
+# If dates is given, only the data for those dates is read.
+# If room_schedules is a dict, it is updated as in get_all_time_slots (read in room order from the index).
+def load_store(
+    fname,
+    time_slots,
+    always_free,
+    update_times,
+    rooms,
+    occupancies=None,
+    dates=None,
+    room_schedules=None,
+):
+    print(f"Loading data from {fname}")
+    con = open_store(fname)
+    try:
+        if dates is None:
+            date_filter, params = "", ()
+        else:
+            date_isos = [iso_of_date_tuple(d) for d in dates]
+            date_filter = f" WHERE date IN ({', '.join('?' * len(date_isos))})"
+            params = tuple(date_isos)
+        query = "SELECT date, room, start_m, end_m FROM slots" + date_filter
+        # Primary key order, so each room schedule is sorted.
+        query += " ORDER BY date, room, start_m, end_m"
+        for date_iso, room_name, start_m, end_m in con.execute(query, params):
+            d = date_tuple_of_iso(date_iso)
+            slot = (tt_of_minutes(start_m), tt_of_minutes(end_m))
+            time_slots.setdefault(d, {}).setdefault(slot, set()).add(room_name)
+            if room_schedules is not None:
+                day_schedules = room_schedules.setdefault(d, {})
+                day_schedules.setdefault(room_name, []).append(slot)
+        query = "SELECT date, update_time FROM dates" + date_filter
+        for date_iso, update_time in con.execute(query, params):
+            update_times[date_tuple_of_iso(date_iso)] = update_time
+        for room_name, room_id, is_always_free in con.execute("SELECT * FROM rooms"):
+            rooms[room_name] = room_id
+            if is_always_free and not room_name in always_free:
+                always_free.append(room_name)
+        if occupancies is not None and np is not None:
+            query = "SELECT * FROM occupancies" + date_filter
+            for date_iso, room_names, bits, ends in con.execute(query, params):
+                occupancies[date_tuple_of_iso(date_iso)] = unpack_occupancy(
+                    {
+                        "room_names": json.loads(room_names),
+                        "bits": bits,
+                        "ends": json.loads(ends),
+                    }
+                )
+    finally:
+        con.close()
+
+
+# Room-major version of the slots of one day: a dict of room_name : sorted slot list,
+# with an empty list for the rooms with no slot.
+def build_room_schedules(day_slots, rooms):
+    room_schedules = {room_name: [] for room_name in rooms}
+    for slot, room_names in day_slots.items():
+        for room_name in room_names:
+            room_schedules.setdefault(room_name, []).append(slot)
+    for schedule in room_schedules.values():
+        schedule.sort()
+    return room_schedules
+
+
+# Returns a copy of time_slots with all the days of the week of date_tuple (empty if not already there).
+# Storing it clears the stored slots of the days of that week which no longer have any slot.
+def with_week_days(time_slots, date_tuple):
+    d = datetime.date(date_tuple[2], date_tuple[1], date_tuple[0])
+    monday = d - datetime.timedelta(days=d.weekday())
+    r = time_slots.copy()
+    for i in range(7):
+        day = monday + datetime.timedelta(days=i)
+        r.setdefault((day.day, day.month, day.year), {})
+    return r
+
+
+# Returns True if the data for a date, downloaded at update_time (a str as in the store), is older
+# than max_age hours. Missing data is stale.
+def is_stale(update_time, max_age):
+    if update_time is None:
+        return True
+    update_d = datetime.datetime.strptime(update_time, "%d/%m/%Y at %H:%M")
+    return datetime.datetime.now() - update_d > datetime.timedelta(hours=max_age)
+
+
+# First and last possible times of day, over all the stored slots (see get_whole_day).
+def get_store_whole_day(fname):
+    con = open_store(fname)
+    try:
+        start_m, end_m = con.execute(
+            "SELECT MIN(start_m), MAX(end_m) FROM slots"
+        ).fetchone()
+    finally:
+        con.close()
+    return (tt_of_minutes(start_m), tt_of_minutes(end_m))
+
+
+# First and last possible times of day, over all the slots of time_slots
+def get_whole_day(time_slots):
+    all_slots = set()
+    for d in time_slots:
+        for slot in time_slots[d]:
+            all_slots.add(slot)
+    return (
+        min([slot[0] for slot in all_slots]),
+        max([slot[1] for slot in all_slots]),
+    )
+
+
+no_schedule_s = "No schedule for that date in the cache.\n(This could mean the building is closed that day, or that the date is too far in the past/future)"
+
+
+# Finds the free rooms using data already loaded or downloaded (see find_and_display_free_rooms).
+# occupancies and room_schedules are used if they contain the date, and whole_day is computed if None.
+# Returns None if there is no schedule for that date, otherwise a dict with keys "date_tuple",
+# "free_rooms_by_start", "room_schedule", "occupancy", "whole_day", "are_all_free", "always_free"
+# and "update_time" (None if the data has been downloaded in the current execution).
+def get_free_rooms_result(
+    time_slots,
+    rooms,
+    always_free,
+    update_times,
+    date_tuple,
+    start_tt,
+    excluded=set(),
+    duration=21,
+    max_delay=30,
+    occupancies={},
+    room_schedules={},
+    whole_day=None,
+):
+    if not date_tuple in time_slots:
+        return None
+    # Find free rooms (using data)
+    excluded_from_search = excluded.copy()
+    excluded_from_search.update(always_free)
+    occupancy = None
+    if np is not None and duration > 0:
+        occupancy = occupancies.get(date_tuple)
+        if occupancy is None or occupancy["room_names"] != sorted(rooms):
+            occupancy = build_occupancy(time_slots[date_tuple], rooms)
+        free_rooms_by_start = find_free_rooms_occupancy(
+            occupancy,
+            start_tt,
+            excluded=excluded_from_search,
+            duration=duration,
+            max_delay=max_delay,
+        )
+    else:
+        day_index = build_day_index(time_slots[date_tuple])
+        free_rooms_by_start = find_free_rooms(
+            time_slots,
+            rooms,
+            date_tuple,
+            start_tt,
+            excluded=excluded_from_search,
+            duration=duration,
+            max_delay=max_delay,
+            day_index=day_index,
+        )
+    nb_free_rooms = sum([len(free_rooms_by_start[k]) for k in free_rooms_by_start])
+    are_all_free = nb_free_rooms + len(excluded_from_search) == len(rooms)
+    # Time slots of the requested day, organized by room
+    if date_tuple in room_schedules:
+        room_schedule = {room_name: [] for room_name in rooms}
+        room_schedule.update(room_schedules[date_tuple])
+    else:
+        # Loaded from a file of an older version
+        room_schedule = build_room_schedules(time_slots[date_tuple], rooms)
+    # Get First and last possible times of day (for the whole week)
+    if whole_day is None:
+        whole_day = get_whole_day(time_slots)
+    return {
+        "date_tuple": date_tuple,
+        "free_rooms_by_start": free_rooms_by_start,
+        "room_schedule": room_schedule,
+        "occupancy": occupancy,
+        "whole_day": whole_day,
+        "are_all_free": are_all_free,
+        "always_free": always_free,
+        "update_time": update_times.get(date_tuple),
+    }
+
+
+def s_of_free_rooms_result(result):
+    if result is None:
+        return no_schedule_s
+    result_s = ""
+    result_s += s_of_free_rooms(
+        result["free_rooms_by_start"],
+        result["date_tuple"],
+        result["room_schedule"],
+        result["whole_day"],
+        result["are_all_free"],
+        always_free=result["always_free"],
+        occupancy=result["occupancy"],
+    )
+    result_s += "\n"
+    if result["update_time"] is not None:
+        result_s += f"The data for this date was downloaded on {result['update_time']}.\nIf the time schedule has been modified since, it might be incorrect.\n"
+    return result_s
+
+
+# Same content as s_of_free_rooms_result, as a json compatible dict.
+def json_of_free_rooms_result(result):
+    if result is None:
+        return {"error": no_schedule_s}
+    whole_day = result["whole_day"]
+    free_rooms = []
+    for start_tt, room_names in result["free_rooms_by_start"].items():
+        free_slot_rooms = get_free_slot_rooms(
+            room_names,
+            start_tt,
+            whole_day,
+            room_schedule=result["room_schedule"],
+            occupancy=result["occupancy"],
+        )
+        free_rooms.append(
+            {
+                "start": s_of_tt(start_tt),
+                "rooms": [
+                    {
+                        "room": room_name,
+                        "free_from": s_of_tt(slot[0]),
+                        "free_until": s_of_tt(slot[1]),
+                        "until_end_of_day": slot[1] == whole_day[1],
+                    }
+                    for slot, room_name in free_slot_rooms
+                ],
+            }
+        )
+    return {
+        "date": s_of_date_tuple(result["date_tuple"]),
+        "free_rooms": free_rooms,
+        "are_all_free": result["are_all_free"],
+        "always_free": list(result["always_free"]),
+        "update_time": result["update_time"],
+    }
 
 
 # Returns result as text
@@ -354,19 +929,102 @@ def find_and_display_free_rooms(
     max_delay=30,
     load_file=None,
     save_file=None,
+    jobs=1,
+    max_age=None,
+    get_session=None,
 ):
     time_slots, always_free, update_times, rooms = {}, [], {}, {}
-    if save_file and os.path.isfile(save_file):
-        load_time_slots(save_file, time_slots, always_free, update_times, rooms)
+    occupancies = {}
+    # Organized by room, filled at the same time as time_slots (when possible)
+    room_schedules = {}
+    whole_day = None
+    # File actually written, replaced by save_file only once written.
+    store_fname = save_file
+    if save_file and os.path.isfile(save_file) and is_pickle_file(save_file):
+        # File written by an older version: its whole content is written back in the new format.
+        if load_file != save_file:
+            load_time_slots(save_file, time_slots, always_free, update_times, rooms)
+        print(f"Converting {save_file} to the new data file format")
+        store_fname = save_file + ".tmp"
+        if os.path.exists(store_fname):
+            os.remove(store_fname)
     # Potentially update save file with load file (without checking update times; TODO?)
     if load_file:
-        load_time_slots(load_file, time_slots, always_free, update_times, rooms)
+        if is_pickle_file(load_file):
+            load_time_slots(
+                load_file,
+                time_slots,
+                always_free,
+                update_times,
+                rooms,
+                occupancies=occupancies,
+            )
+        else:
+            # Only read the requested date, unless everything is copied to the save file.
+            load_store(
+                load_file,
+                time_slots,
+                always_free,
+                update_times,
+                rooms,
+                occupancies=occupancies,
+                dates=None if save_file else [date_tuple],
+                room_schedules=room_schedules,
+            )
+            if (
+                max_age is not None
+                and not save_file
+                and is_stale(update_times.get(date_tuple), max_age)
+            ):
+                # Refresh the week of the requested date only, and write it back to the store.
+                print(
+                    f"The data for {s_of_date_tuple(date_tuple)} is missing or older than {max_age} hour(s), downloading it again."
+                )
+                if s is None:
+                    s = get_session()
+                request_date_change(s, date_tuple)
+                # Rooms with no schedule in the weeks already stored
+                stored_always_free = set(always_free) if rooms else None
+                if not rooms:
+                    rooms.update(get_room_ids(s))
+                new_room_schedules = {}
+                # All rooms: the update times are kept by date, so all the rooms of the week are
+                # stale together, and the days written replace those of the store (excluded rooms
+                # are only left out of the result).
+                new_time_slots, new_always_free = get_all_time_slots(
+                    s,
+                    rooms,
+                    jobs=jobs,
+                    room_schedules=new_room_schedules,
+                )
+                # As in prefetch_free_rooms, a room is always free only if it is free in all
+                # the stored weeks.
+                if stored_always_free is None:
+                    always_free = list(new_always_free)
+                else:
+                    always_free = list(stored_always_free & set(new_always_free))
+                store_time_slots(
+                    load_file,
+                    with_week_days(new_time_slots, date_tuple),
+                    always_free,
+                    {},
+                    rooms,
+                )
+                for d in with_week_days(new_time_slots, date_tuple):
+                    time_slots.pop(d, None)
+                    update_times.pop(d, None)
+                    occupancies.pop(d, None)
+                    room_schedules.pop(d, None)
+                time_slots.update(new_time_slots)
+                room_schedules.update(new_room_schedules)
+            if date_tuple in time_slots:
+                whole_day = get_store_whole_day(load_file)
     else:
         # Do the requests
         request_date_change(s, date_tuple)
         rooms = get_room_ids(s)
         new_time_slots, new_always_free = get_all_time_slots(
-            s, rooms, excluded=excluded
+            s, rooms, excluded=excluded, jobs=jobs, room_schedules=room_schedules
         )
         for d in new_time_slots:
             # The absence of a date in update_times represents the fact that it has been updated in
@@ -375,57 +1033,486 @@ def find_and_display_free_rooms(
         time_slots.update(new_time_slots)
         always_free = list(set(always_free) - set(new_always_free))
     if save_file:
-        save_time_slots(save_file, time_slots, always_free, update_times, rooms)
+        # Only the dates in time_slots are written (those downloaded, loaded or converted).
+        if not load_file:
+            time_slots = with_week_days(time_slots, date_tuple)
+        store_time_slots(store_fname, time_slots, always_free, update_times, rooms)
+        if store_fname != save_file:
+            os.replace(store_fname, save_file)
         return ""
-    if not date_tuple in time_slots:
-        return "No schedule for that date in the cache.\n(This could mean the building is closed that day, or that the date is too far in the past/future)"
-    # Find free rooms (using data)
-    excluded_from_search = excluded.copy()
-    excluded_from_search.update(always_free)
-    free_rooms_by_start = find_free_rooms(
+    result = get_free_rooms_result(
         time_slots,
         rooms,
+        always_free,
+        update_times,
         date_tuple,
         start_tt,
-        excluded=excluded_from_search,
+        excluded=excluded,
         duration=duration,
         max_delay=max_delay,
+        occupancies=occupancies,
+        room_schedules=room_schedules,
+        whole_day=whole_day,
     )
-    nb_free_rooms = sum([len(free_rooms_by_start[k]) for k in free_rooms_by_start])
-    are_all_free = nb_free_rooms + len(excluded_from_search) == len(rooms)
-    # Reorganize the time slots by room (could have been computed at the same time as time_slots).
+    return s_of_free_rooms_result(result)
+
+
+# Downloads the schedules of all rooms for each week from the week of first_date_tuple to the week
+# of last_date_tuple (included), with a single session, and writes them to the save file.
+# Each week is written as soon as it is downloaded, so an interrupted run keeps the weeks already done.
+# All rooms are downloaded, as the days written replace those of the save file (excluded rooms are
+# only left out when displaying the free rooms).
+@pronote.notimplemented
+def prefetch_free_rooms(s, first_date_tuple, last_date_tuple, save_file, jobs=1):
+    first_d = datetime.date(
+        first_date_tuple[2], first_date_tuple[1], first_date_tuple[0]
+    )
+    last_d = datetime.date(last_date_tuple[2], last_date_tuple[1], last_date_tuple[0])
+    if last_d < first_d:
+        raise RuntimeError("The last date of the prefetch is before the first date.")
+    # Mondays of each week
+    week_ds = []
+    week_d = first_d - datetime.timedelta(days=first_d.weekday())
+    while week_d <= last_d:
+        week_ds.append(week_d)
+        week_d += datetime.timedelta(weeks=1)
+    rooms = get_room_ids(s)
+    # Rooms with no schedule for any of the weeks
+    always_free = None
+    for i, week_d in enumerate(week_ds):
+        week_date_tuple = (week_d.day, week_d.month, week_d.year)
+        print(f"Week of {s_of_date_tuple(week_date_tuple)} ({i + 1}/{len(week_ds)})")
+        request_date_change(s, week_date_tuple)
+        time_slots, week_always_free = get_all_time_slots(s, rooms, jobs=jobs)
+        if always_free is None:
+            always_free = set(week_always_free)
+        else:
+            always_free &= set(week_always_free)
+        store_time_slots(
+            save_file,
+            with_week_days(time_slots, week_date_tuple),
+            list(always_free),
+            {},
+            rooms,
+        )
+
+
+## Query service
+# Logs in once, keeps the data of the requested weeks in memory (downloaded again in the background
+# every refresh_interval minutes), and answers queries over HTTP on localhost, for example:
+#   http://localhost:PORT/?date=DD/MM/YYYY&time=HH:MM&duration=21&max_delay=30&excluded=ROOM1,ROOM2
+# Date and time default to the current ones. Add "format=json" for a json answer instead of text.
+
+
+# Returns the data of the week of date_tuple, as a dict with the same keys as the arguments of
+# get_free_rooms_result.
+def download_week_data(s, date_tuple, rooms, excluded=set(), jobs=1):
+    request_date_change(s, date_tuple)
     room_schedules = {}
-    for d in time_slots:
-        room_schedules[d] = {}
-        for room_name in rooms:
-            schedule = [
-                slot for slot in time_slots[d] if room_name in time_slots[d][slot]
-            ]
-            schedule.sort()
-            room_schedules[d][room_name] = schedule
-    # Get First and last possible times of day (for the whole week)
-    all_slots = set()
-    for d in time_slots:
-        for slot in time_slots[d]:
-            all_slots.add(slot)
-    whole_day = (
-        min([slot[0] for slot in all_slots]),
-        max([slot[1] for slot in all_slots]),
+    time_slots, always_free = get_all_time_slots(
+        s, rooms, excluded=excluded, jobs=jobs, room_schedules=room_schedules
     )
-    # Display result
-    result_s = ""
-    result_s += s_of_free_rooms(
-        free_rooms_by_start,
+    return {
+        "time_slots": time_slots,
+        "rooms": rooms,
+        "always_free": always_free,
+        "update_times": {},
+        "occupancies": {},
+        "room_schedules": room_schedules,
+    }
+
+
+def monday_of_date_tuple(date_tuple):
+    d = datetime.date(date_tuple[2], date_tuple[1], date_tuple[0])
+    monday = d - datetime.timedelta(days=d.weekday())
+    return (monday.day, monday.month, monday.year)
+
+
+# Returns (body, content_type) for the query parameters params (a dict of str : str).
+def answer_free_rooms_query(get_week_data, params, excluded=set()):
+    curr_d = datetime.datetime.now()
+    date_tuple = (curr_d.day, curr_d.month, curr_d.year)
+    start_tt = (curr_d.hour, curr_d.minute)
+    if params.get("date"):
+        date_tuple = tuple_of_date_dmy(params["date"])
+        if not date_tuple:
+            raise ValueError("Invalid format for date (should be DD/MM/YYYY)")
+    if params.get("time"):
+        start_tt = tuple_of_time_hhmm(params["time"])
+        if not start_tt:
+            raise ValueError("Invalid format for time (should be HH:MM)")
+    query_excluded = set(excluded)
+    if params.get("excluded"):
+        query_excluded.update(params["excluded"].split(","))
+    data = get_week_data(date_tuple)
+    result = get_free_rooms_result(
+        data["time_slots"],
+        data["rooms"],
+        data["always_free"],
+        data["update_times"],
         date_tuple,
-        room_schedules[date_tuple],
-        whole_day,
-        are_all_free,
-        always_free=always_free,
+        start_tt,
+        excluded=query_excluded,
+        duration=int(params.get("duration", 21)),
+        max_delay=int(params.get("max_delay", 30)),
+        occupancies=data["occupancies"],
+        room_schedules=data["room_schedules"],
+        whole_day=data.get("whole_day"),
     )
-    result_s += "\n"
-    if date_tuple in update_times:
-        result_s += f"The data for this date was downloaded on {update_times[date_tuple]}.\nIf the time schedule has been modified since, it might be incorrect.\n"
-    return result_s
+    if params.get("format") == "json":
+        return (
+            json.dumps(json_of_free_rooms_result(result), ensure_ascii=False),
+            "application/json; charset=utf-8",
+        )
+    return s_of_free_rooms_result(result), "text/plain; charset=utf-8"
+
+
+def make_free_rooms_handler(answer_query):
+    class FreeRoomsHandler(http.server.BaseHTTPRequestHandler):
+        def do_GET(self):
+            query = urllib.parse.urlparse(self.path).query
+            params = {k: v[-1] for k, v in urllib.parse.parse_qs(query).items()}
+            status = 200
+            try:
+                body, content_type = answer_query(params)
+            except (ValueError, RuntimeError, requests.RequestException) as e:
+                status = 400 if isinstance(e, ValueError) else 502
+                body, content_type = f"Error: {e}\n", "text/plain; charset=utf-8"
+            body_bytes = body.encode("utf-8")
+            self.send_response(status)
+            self.send_header("Content-Type", content_type)
+            self.send_header("Content-Length", str(len(body_bytes)))
+            self.end_headers()
+            self.wfile.write(body_bytes)
+
+        def log_message(self, format, *args):
+            logging.debug("%s - %s", self.address_string(), format % args)
+
+    return FreeRoomsHandler
+
+
+# Runs until interrupted. open_session_fun is called (without arguments) to login, at start and
+# again if a download fails (for example because the session expired).
+# Weeks not in memory are read from load_file if it contains the date, otherwise downloaded. All
+# the weeks in memory (loaded or downloaded) are downloaded again every refresh_interval minutes.
+@pronote.notimplemented
+def serve_free_rooms(
+    open_session_fun,
+    port,
+    refresh_interval=60,
+    excluded=set(),
+    load_file=None,
+    jobs=1,
+):
+    # Only one thread at a time uses the website session.
+    site_lock = threading.Lock()
+    session = {"s": open_session_fun(), "rooms": None}
+    # dict of monday date_tuple : week data (see download_week_data)
+    weeks = {}
+    weeks_lock = threading.Lock()
+    # Only one thread at a time loads or downloads a week missing from weeks, so that concurrent
+    # queries for a same week do not download it several times.
+    fetch_lock = threading.Lock()
+
+    def download_week(date_tuple):
+        with site_lock:
+            for attempt in range(2):
+                try:
+                    if session["rooms"] is None:
+                        session["rooms"] = get_room_ids(session["s"])
+                    return download_week_data(
+                        session["s"], date_tuple, session["rooms"], excluded, jobs
+                    )
+                except (RuntimeError, requests.RequestException) as e:
+                    if attempt > 0:
+                        raise
+                    print(f"Warning: download failed ({e}), logging in again.")
+                    close_session(session["s"])
+                    session["s"] = open_session_fun()
+
+    def load_week(date_tuple):
+        data = {
+            "time_slots": {},
+            "always_free": [],
+            "update_times": {},
+            "rooms": {},
+            "occupancies": {},
+            "room_schedules": {},
+        }
+        load_store(
+            load_file,
+            data["time_slots"],
+            data["always_free"],
+            data["update_times"],
+            data["rooms"],
+            occupancies=data["occupancies"],
+            dates=list(with_week_days({}, date_tuple)),
+            room_schedules=data["room_schedules"],
+        )
+        if not date_tuple in data["time_slots"]:
+            return None
+        data["whole_day"] = get_store_whole_day(load_file)
+        return data
+
+    def get_week_data(date_tuple):
+        monday = monday_of_date_tuple(date_tuple)
+        with weeks_lock:
+            if monday in weeks:
+                return weeks[monday]
+        with fetch_lock:
+            with weeks_lock:
+                if monday in weeks:
+                    return weeks[monday]
+            data = None
+            if load_file and not is_pickle_file(load_file):
+                data = load_week(date_tuple)
+            if data is None:
+                data = download_week(date_tuple)
+            with weeks_lock:
+                weeks[monday] = data
+            return data
+
+    def refresh_loop():
+        while not stop_event.wait(refresh_interval * 60):
+            with weeks_lock:
+                mondays = list(weeks)
+            for monday in mondays:
+                try:
+                    data = download_week(monday)
+                    with weeks_lock:
+                        weeks[monday] = data
+                except (RuntimeError, requests.RequestException) as e:
+                    print(
+                        f"Warning: refresh of the week of {s_of_date_tuple(monday)} failed: {e}"
+                    )
+
+    curr_d = datetime.datetime.now()
+    get_week_data((curr_d.day, curr_d.month, curr_d.year))
+    stop_event = threading.Event()
+    refresh_thread = threading.Thread(target=refresh_loop, daemon=True)
+    refresh_thread.start()
+    handler = make_free_rooms_handler(
+        lambda params: answer_free_rooms_query(get_week_data, params, excluded)
+    )
+    server = http.server.ThreadingHTTPServer(("127.0.0.1", port), handler)
+    print(f"Answering queries on http://localhost:{port}/ (interrupt with Ctrl+C)")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        stop_event.set()
+        server.server_close()
+        close_session(session["s"])
+
+
+## Batch report
+# Answers every (date, start time) of a grid in one run, from data loaded or downloaded once.
+
+
+# Returns the list of date_tuples for a batch date argument: "DD/MM/YYYY", or a range of days
+# "DD/MM/YYYY-DD/MM/YYYY" (both included).
+def date_tuples_of_batch_arg(date_s):
+    if "-" in date_s:
+        first_s, last_s = date_s.split("-", 1)
+        first_date_tuple = tuple_of_date_dmy(first_s)
+        last_date_tuple = tuple_of_date_dmy(last_s)
+        if not (first_date_tuple and last_date_tuple):
+            raise RuntimeError(f"Invalid format for date range: {date_s}")
+        first_d = datetime.date(*reversed(first_date_tuple))
+        last_d = datetime.date(*reversed(last_date_tuple))
+        return [
+            (d.day, d.month, d.year)
+            for d in (
+                first_d + datetime.timedelta(days=i)
+                for i in range((last_d - first_d).days + 1)
+            )
+        ]
+    date_tuple = tuple_of_date_dmy(date_s)
+    if not date_tuple:
+        raise RuntimeError(f"Invalid format for date: {date_s}")
+    return [date_tuple]
+
+
+batch_header = ["date", "time", "free_at", "room", "free_from", "free_until"]
+
+
+# Returns a list of rows (see batch_header), as str, for each date and start time.
+# The arguments are the same as get_free_rooms_result, with lists of dates and start times.
+def get_free_rooms_batch_rows(
+    time_slots,
+    rooms,
+    always_free,
+    update_times,
+    date_tuples,
+    start_tts,
+    excluded=set(),
+    duration=21,
+    max_delay=30,
+    occupancies={},
+    room_schedules={},
+    whole_day=None,
+):
+    if whole_day is None and time_slots:
+        whole_day = get_whole_day(time_slots)
+    rows = []
+    for date_tuple in date_tuples:
+        if not date_tuple in time_slots:
+            continue
+        # Built once per date instead of once per query
+        if np is not None and not date_tuple in occupancies:
+            occupancies[date_tuple] = build_occupancy(time_slots[date_tuple], rooms)
+        if not date_tuple in room_schedules:
+            room_schedules[date_tuple] = build_room_schedules(
+                time_slots[date_tuple], rooms
+            )
+        for start_tt in start_tts:
+            result = get_free_rooms_result(
+                time_slots,
+                rooms,
+                always_free,
+                update_times,
+                date_tuple,
+                start_tt,
+                excluded=excluded,
+                duration=duration,
+                max_delay=max_delay,
+                occupancies=occupancies,
+                room_schedules=room_schedules,
+                whole_day=whole_day,
+            )
+            for free_at, room_names in result["free_rooms_by_start"].items():
+                free_slot_rooms = get_free_slot_rooms(
+                    room_names,
+                    free_at,
+                    whole_day,
+                    room_schedule=result["room_schedule"],
+                    occupancy=result["occupancy"],
+                )
+                for slot, room_name in free_slot_rooms:
+                    rows.append(
+                        [
+                            s_of_date_tuple(date_tuple),
+                            s_of_tt(start_tt),
+                            s_of_tt(free_at),
+                            room_name,
+                            s_of_tt(slot[0]),
+                            s_of_tt(slot[1]),
+                        ]
+                    )
+    return rows
+
+
+def s_of_batch_rows(rows, output_format="table"):
+    if output_format == "csv":
+        f = io.StringIO()
+        csv.writer(f, lineterminator="\n").writerows([batch_header] + rows)
+        return f.getvalue()
+    widths = [
+        max([len(row[i]) for row in [batch_header] + rows])
+        for i in range(len(batch_header))
+    ]
+    return "".join(
+        [
+            "   ".join([cell.ljust(w) for cell, w in zip(row, widths)]).rstrip() + "\n"
+            for row in [batch_header] + rows
+        ]
+    )
+
+
+# Returns the batch report as text (see get_free_rooms_batch_rows).
+# start_time_strs are HH:MM strings, or "periods" for the start times of the usual time slots of
+# the school (guessed from the data).
+# Without load_file, the weeks of the dates are downloaded (once each).
+@pronote.notimplemented
+def find_free_rooms_batch(
+    s,
+    date_tuples,
+    start_time_strs,
+    excluded=set(),
+    duration=21,
+    max_delay=30,
+    load_file=None,
+    jobs=1,
+    output_format="table",
+):
+    time_slots, always_free, update_times, rooms = {}, [], {}, {}
+    occupancies, room_schedules = {}, {}
+    whole_day = None
+    if load_file:
+        if is_pickle_file(load_file):
+            load_time_slots(
+                load_file,
+                time_slots,
+                always_free,
+                update_times,
+                rooms,
+                occupancies=occupancies,
+            )
+        else:
+            # All the dates in a single read
+            load_store(
+                load_file,
+                time_slots,
+                always_free,
+                update_times,
+                rooms,
+                occupancies=occupancies,
+                dates=date_tuples,
+                room_schedules=room_schedules,
+            )
+            if time_slots:
+                whole_day = get_store_whole_day(load_file)
+    else:
+        rooms.update(get_room_ids(s))
+        # Rooms with no schedule for any of the weeks (as in prefetch_free_rooms)
+        week_always_free = None
+        for monday in sorted(
+            {monday_of_date_tuple(d) for d in date_tuples}, key=lambda d: d[::-1]
+        ):
+            print(f"Week of {s_of_date_tuple(monday)}")
+            data = download_week_data(s, monday, rooms, excluded=excluded, jobs=jobs)
+            time_slots.update(data["time_slots"])
+            room_schedules.update(data["room_schedules"])
+            if week_always_free is None:
+                week_always_free = set(data["always_free"])
+            else:
+                week_always_free &= set(data["always_free"])
+        always_free = list(week_always_free or [])
+    missing = [d for d in date_tuples if not d in time_slots]
+    if missing:
+        print(
+            f"No schedule for {len(missing)} date(s): {', '.join([s_of_date_tuple(d) for d in missing])}"
+        )
+    start_tts = []
+    for time_s in start_time_strs:
+        if time_s == "periods":
+            start_tts += [slot[0] for slot in guess_base_time_slots(time_slots)]
+            continue
+        try:
+            start_tt = tuple_of_time_hhmm(time_s)
+        except ValueError as e:
+            raise RuntimeError(str(e))
+        if not start_tt:
+            raise RuntimeError(
+                f"Invalid format for time string (should be HH:MM): {time_s}"
+            )
+        start_tts.append(start_tt)
+    rows = get_free_rooms_batch_rows(
+        time_slots,
+        rooms,
+        always_free,
+        update_times,
+        date_tuples,
+        sorted(set(start_tts)),
+        excluded=excluded,
+        duration=duration,
+        max_delay=max_delay,
+        occupancies=occupancies,
+        room_schedules=room_schedules,
+        whole_day=whole_day,
+    )
+    return s_of_batch_rows(rows, output_format=output_format)
 
 
 def tuple_of_date_dmy(date_s):
@@ -440,6 +1527,7 @@ def tuple_of_date_dmy(date_s):
         return None
 
 
+# Returns None if time_s is not in the HH:MM format, raises ValueError if it is not a valid time.
 def tuple_of_time_hhmm(time_s):
     if not time_s:
         return None
@@ -449,9 +1537,14 @@ def tuple_of_time_hhmm(time_s):
         if not r:
             return None
         gs = r.groups()
-        return int(gs[0]), int(gs[2])
+        hours, minutes = int(gs[0]), int(gs[2])
     except TypeError:
         return None
+    if not (0 <= hours <= 23 and 0 <= minutes <= 59):
+        raise ValueError(
+            f"Invalid time (hours must be 0-23 and minutes 0-59): {time_s}"
+        )
+    return hours, minutes
 
 
 # Returns a str HH:MM
@@ -460,7 +1553,11 @@ def input_time_hhmm(prompt="Enter a time."):
         time = input_str(prompt=prompt + " Format is HH:MM")
         if not time:
             return ""
-        t = tuple_of_time_hhmm(time)
+        try:
+            t = tuple_of_time_hhmm(time)
+        except ValueError as e:
+            print(e)
+            continue
         if t:
             return f"{t[0]:02d}:{t[1]:02d}"
         print("Invalid time format. Format is HH:MM")
@@ -533,7 +1630,89 @@ def main():
                 {
                     "metavar": "FILE",
                     "type": str,
-                    "help": "Save the data downloaded from the website to the given file then exit. If the file already exists, it will be updated.",
+                    "help": "Save the data downloaded from the website to the given file then exit. If the file already exists, it will be updated (only the downloaded dates are rewritten).",
+                },
+            ),
+            (
+                ("--weeks",),
+                {
+                    "metavar": "N",
+                    "type": int,
+                    "help": "Prefetch mode: download the schedules of all rooms for N consecutive weeks, starting with the week of the given date (or the current date), and write them to the --save file.",
+                },
+            ),
+            (
+                ("--from",),
+                {
+                    "dest": "from_date",
+                    "metavar": "DATE",
+                    "help": "Prefetch mode: download the schedules of all rooms for every week from this date to the --to date (or the given date, or the current date), and write them to the --save file. Format is DD/MM/YYYY.",
+                },
+            ),
+            (
+                ("--to",),
+                {
+                    "dest": "to_date",
+                    "metavar": "DATE",
+                    "help": "Last date for the prefetch mode (see --from). Format is DD/MM/YYYY.",
+                },
+            ),
+            (
+                ("--max-age",),
+                {
+                    "metavar": "HOURS",
+                    "type": float,
+                    "help": "With --load: if the data for the requested date is older than this (or missing), download again the week of that date (with the room list of the file) and update the file. Default is to always use the data of the file.",
+                },
+            ),
+            (
+                ("--serve",),
+                {
+                    "metavar": "PORT",
+                    "type": int,
+                    "help": "Service mode: login once, then answer queries on http://localhost:PORT/?date=DD/MM/YYYY&time=HH:MM (other parameters: duration, max_delay, excluded=ROOM1,ROOM2, format=json) until interrupted. The data is kept in memory and downloaded again regularly (see --refresh-interval).",
+                },
+            ),
+            (
+                ("--refresh-interval",),
+                {
+                    "metavar": "MINUTES",
+                    "type": float,
+                    "default": 60,
+                    "help": "Service mode: time between downloads of the data kept in memory. Default is 60.",
+                },
+            ),
+            (
+                ("--batch-times",),
+                {
+                    "metavar": "TIME",
+                    "nargs": "+",
+                    "help": 'Batch mode: report the free rooms at each of these times (format is HH:MM), for each date of --batch-dates. "periods" stands for the start times of the usual time slots of the school. Works with --load (read once) or downloads each needed week once.',
+                },
+            ),
+            (
+                ("--batch-dates",),
+                {
+                    "metavar": "DATE",
+                    "nargs": "+",
+                    "help": "Batch mode: dates for the report, as DD/MM/YYYY or ranges DD/MM/YYYY-DD/MM/YYYY. Default is the given date (or the current date).",
+                },
+            ),
+            (
+                ("--batch-format",),
+                {
+                    "choices": ["table", "csv"],
+                    "default": "table",
+                    "help": "Batch mode: output format. Default is table.",
+                },
+            ),
+            (
+                ("--jobs",),
+                {
+                    "metavar": "N",
+                    "type": int,
+                    "default": 1,
+                    "help": "Number of room schedules to download at the same time. Default is 1 (one room after the other).",
                 },
             ),
         ]
@@ -547,10 +1726,36 @@ def main():
         start_tt = None
         date_tuple = None
         curr_d = datetime.datetime.now()
+        is_prefetch = bool(args["weeks"] or args["from_date"] or args["to_date"])
+        is_batch = bool(args["batch_times"])
+        if is_batch and (is_prefetch or args["save"] or args["serve"] is not None):
+            raise RuntimeError(
+                "The batch mode (--batch-times) cannot be used with --save, --serve or the prefetch options."
+            )
+        if args["serve"] is not None and (is_prefetch or args["save"]):
+            raise RuntimeError(
+                "The service mode (--serve) cannot be used with --save or the prefetch options."
+            )
+        if is_prefetch:
+            if not args["save"]:
+                raise RuntimeError(
+                    "The prefetch options --weeks, --from and --to need a --save file."
+                )
+            if args["load"]:
+                raise RuntimeError(
+                    "The prefetch options --weeks, --from and --to download from the website and cannot be used with --load."
+                )
         if args["now"]:
             args["date"] = None
             args["time"] = None
-        elif (not args["now"]) and (args["date"] is None) and (args["time"] is None):
+        elif (
+            (not args["now"])
+            and (not is_prefetch)
+            and (not is_batch)
+            and (args["serve"] is None)
+            and (args["date"] is None)
+            and (args["time"] is None)
+        ):
             choice = input_Yn(prompt="Use the current date and time?")
             if not choice:
                 # Ask for date
@@ -571,7 +1776,10 @@ def main():
             date_tuple = (curr_d.day, curr_d.month, curr_d.year)
             print(f"Using current date {s_of_date_tuple(date_tuple)}")
         if args["time"]:
-            start_tt = tuple_of_time_hhmm(args["time"])
+            try:
+                start_tt = tuple_of_time_hhmm(args["time"])
+            except ValueError as e:
+                raise RuntimeError(str(e))
             if not start_tt:
                 raise RuntimeError(
                     f"Invalid format for time string (should be HH:MM): {args['time']}"
@@ -582,11 +1790,72 @@ def main():
         excluded = set()
         if args["excluded_rooms"]:
             excluded = set(args["excluded_rooms"])
+        first_date_tuple, last_date_tuple = None, None
+        if is_prefetch:
+            first_date_tuple = date_tuple
+            if args["from_date"]:
+                first_date_tuple = tuple_of_date_dmy(args["from_date"])
+            last_date_tuple = first_date_tuple
+            if args["to_date"]:
+                last_date_tuple = tuple_of_date_dmy(args["to_date"])
+            elif args["weeks"]:
+                first_d = datetime.date(
+                    first_date_tuple[2], first_date_tuple[1], first_date_tuple[0]
+                )
+                last_d = first_d + datetime.timedelta(weeks=args["weeks"] - 1)
+                last_date_tuple = (last_d.day, last_d.month, last_d.year)
+            if not (first_date_tuple and last_date_tuple):
+                raise RuntimeError(
+                    "Invalid format for prefetch date string (should be DD/MM/YYYY)."
+                )
         # Done processing args
         s = None
+        if args["serve"] is not None:
+            serve_free_rooms(
+                lambda: open_session_from_args(args),
+                args["serve"],
+                refresh_interval=args["refresh_interval"],
+                excluded=excluded,
+                load_file=args["load"],
+                jobs=args["jobs"],
+            )
+            return
         if not args["load"]:
             s = open_session_from_args(args)
 
+        # With --load, only login if the data needs to be refreshed (see --max-age).
+        def get_session():
+            nonlocal s
+            if s is None:
+                s = open_session_from_args(args)
+            return s
+
+        if is_batch:
+            date_tuples = [date_tuple]
+            if args["batch_dates"]:
+                date_tuples = []
+                for date_s in args["batch_dates"]:
+                    date_tuples += date_tuples_of_batch_arg(date_s)
+            result_s = find_free_rooms_batch(
+                s,
+                date_tuples,
+                args["batch_times"],
+                excluded=excluded,
+                duration=args["duration"],
+                max_delay=args["max_delay"],
+                load_file=args["load"],
+                jobs=args["jobs"],
+                output_format=args["batch_format"],
+            )
+        elif is_prefetch:
+            prefetch_free_rooms(
+                s,
+                first_date_tuple,
+                last_date_tuple,
+                args["save"],
+                jobs=args["jobs"],
+            )
+            return
         result_s = find_and_display_free_rooms(
             s,
             date_tuple,
@@ -596,6 +1865,9 @@ def main():
             max_delay=args["max_delay"],
             load_file=args["load"],
             save_file=args["save"],
+            jobs=args["jobs"],
+            max_age=args["max_age"],
+            get_session=get_session,
         )
         print(result_s)
         output_file = args["output"]
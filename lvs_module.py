@@ -5,11 +5,24 @@ Scripting for an Axess website.
 
 from guify import *
 import pronote
+import request_layer
+import response_cache
+import private_file
+import session_store
 
 import logging
 import requests
 import argparse
 import appdirs
+from bs4 import BeautifulSoup, SoupStrainer
+
+try:
+    import lxml
+
+    # Faster than the default parser, if available.
+    html_parser = "lxml"
+except ImportError:
+    html_parser = "html.parser"
 
 import json
 import csv
@@ -20,6 +33,8 @@ import time
 import datetime
 import re
 import functools
+import threading
+import concurrent.futures
 
 appname = "LVSconnect"
 config_fname = appname + "_config.json"
@@ -48,6 +63,10 @@ def get_url(name):
     return base_url + urls[name]
 
 
+def get_base_url():
+    return base_url
+
+
 # login
 add_url("login", "/login")
 add_url("connexion", "/vsn.main/WSAuth/connexion")
@@ -64,6 +83,24 @@ add_url("recus", "/vsn.main/WSmessagerie/avecpages/2/0")
 add_url("get_groups", "/vsn.main/WSCompetences/loadServicesProf")
 add_url("get_grades", "/vsn.main/WSCompetences/loadDevoirsNotesMoyennes")
 
+# modules (see open_module)
+add_url("get_module_url", "/vsn.main/WSMenu/getModuleUrl")
+add_url("absence_start", "/vsn.main/absence/absenceStart")
+
+# dict of module name : (mod parameter of getModuleUrl, url name of the start page, start params)
+modules = {
+    "absences": (
+        "ABSENCES",
+        "absence_start",
+        {
+            "actionEnd": "calendrierAbsenceEleve",
+            "type": "absence",
+            "idEleve": "",
+            "accesDeMenu": "true",
+        },
+    ),
+}
+
 
 def update_config_from_file(config_dict, fname, silent=False):
     try:
@@ -117,6 +154,34 @@ def update_config_file(config_dict):
         print(f"Warning: error writing config file {ffname}:\n  {e}")
 
 
+# Returns the full name of a file in the user cache dir (for data that can be downloaded again).
+def get_cache_fname(fname):
+    dirs = appdirs.AppDirs(appname, appauthor=False)
+    return os.path.join(os.path.abspath(dirs.user_cache_dir), fname)
+
+
+def read_cache_json(fname):
+    ffname = get_cache_fname(fname)
+    try:
+        with open(ffname) as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return {}
+    except (json.decoder.JSONDecodeError, PermissionError) as e:
+        print(f"Warning: error reading cache file {ffname}:\n  {e}")
+        return {}
+
+
+# The cache files can hold personal data (for example absences), so they are only readable by the
+# user.
+def write_cache_json(fname, j):
+    ffname = get_cache_fname(fname)
+    try:
+        private_file.write_private_json(ffname, j)
+    except PermissionError as e:
+        print(f"Warning: error writing cache file {ffname}:\n  {e}")
+
+
 ## We warp argparse to avoid duplicating code.
 
 # Passed each as parser.add_argument(*a, **ka)
@@ -195,6 +260,14 @@ shared_arg_descs = [
             "help": "4-digit account PIN for Pronote registration.",
         },
     ),
+    (
+        ("--session_store",),
+        {
+            "dest": "session_store",
+            "action": argparse.BooleanOptionalAction,
+            "help": "Keep the login session in an encrypted file in the user cache dir, so that the next runs do not need to log in again (the password is still needed). Default is to not keep it.",
+        },
+    ),
     (
         ("--ent_name",),
         {
@@ -205,6 +278,42 @@ shared_arg_descs = [
 ]
 
 
+# Guesses the csv file, group name and trimester args if they were not given (the last two from
+# the csv file).
+# Done by lvs_get_args, unless they are in its dont_process arg.
+def process_csv_args(
+    args,
+    process_csv=True,
+    process_group=True,
+    process_trimester=True,
+    required=[],
+    prompt_csv=True,
+    silent_csv=False,
+    confirm_csv=False,
+):
+    if process_csv:
+        if args["csv_fname"] is None:
+            args["csv_fname"] = get_csv_filename(
+                prompt_if_notfound=prompt_csv, silent=silent_csv, confirm=confirm_csv
+            )
+            if not args["csv_fname"]:
+                if "csv_fname" in required:
+                    raise RuntimeError("Unable to find or guess CSV file.")
+                else:
+                    args["csv_fname"] = None
+    if process_group:
+        if args["group_name"] is None:
+            if args.get("csv_fname"):
+                args["group_name"] = get_group_name_from_csv(args["csv_fname"])
+    if process_trimester:
+        if args["trimester"] is None:
+            if args.get("csv_fname"):
+                args["trimester"] = get_trimester_from_csv_fname(args["csv_fname"])
+        if args["trimester"] is None:
+            args["trimester"] = guess_trimester_from_date()
+    return args
+
+
 def lvs_get_args(
     arg_descs=[],
     shared_args=[],
@@ -227,6 +336,7 @@ def lvs_get_args(
         "device_name",
         "account_pin",
         "ent_name",
+        "session_store",
     ]
     shared_args.update(common_arg_names)
     parser = argparse.ArgumentParser(description=description)
@@ -270,6 +380,24 @@ def lvs_get_args(
     if should_process("debug"):
         if args["debug"]:
             logging.basicConfig(level=logging.DEBUG)
+    request_layer.set_request_limits(
+        max_in_flight=args.get("max_requests_in_flight"),
+        rate=args.get("request_rate"),
+        timeout=args.get("request_timeout"),
+        retries=args.get("max_retries"),
+    )
+    request_layer.set_transport_options(
+        size=args.get("http_pool_size"), http2=args.get("http2")
+    )
+    # The responses are kept on disk only if asked for, as they contain students data.
+    response_cache.set_cache_options(
+        ttls=args.get("response_cache_ttls"),
+        fname=(
+            get_cache_fname(response_cache_fname)
+            if args.get("response_cache_disk")
+            else None
+        ),
+    )
     if should_process("dry-run"):
         if args["dry_run"] is None:
             args["dry_run"] = False
@@ -291,42 +419,157 @@ def lvs_get_args(
             update_config_file({"login_url": url})
         args["login_url"] = url
         pronote.initialize(login_url=url)
-    if should_process("csv_fname") or should_process("csv_file"):
-        if args["csv_fname"] is None:
-            args["csv_fname"] = get_csv_filename(
-                prompt_if_notfound=prompt_csv, silent=silent_csv, confirm=confirm_csv
-            )
-            if not args["csv_fname"]:
-                if "csv_fname" in required:
-                    raise RuntimeError("Unable to find or guess CSV file.")
-                else:
-                    args["csv_fname"] = None
-    if should_process("group"):
-        if args["group_name"] is None:
-            if args.get("csv_fname"):
-                args["group_name"] = get_group_name_from_csv(args["csv_fname"])
-    if should_process("trimester"):
-        if args["trimester"] is None:
-            if args.get("csv_fname"):
-                args["trimester"] = get_trimester_from_csv_fname(args["csv_fname"])
-        if args["trimester"] is None:
-            args["trimester"] = guess_trimester_from_date()
+    process_csv_args(
+        args,
+        process_csv=should_process("csv_fname") or should_process("csv_file"),
+        process_group=should_process("group"),
+        process_trimester=should_process("trimester"),
+        required=required,
+        prompt_csv=prompt_csv,
+        silent_csv=silent_csv,
+        confirm_csv=confirm_csv,
+    )
     return args
 
 
+# Session used for the website. All its requests go through request_layer (limits, retries of the
+# idempotent requests, circuit breaker).
+# Requests take an extra idempotent argument (default True only for GET, HEAD and OPTIONS), for
+# the POST requests which only read data, and an extra retry_server_errors argument (see
+# request_layer.controlled_call).
+# The limits can be set in the config file ("max_requests_in_flight", "request_rate",
+# "request_timeout" and "max_retries"), as well as the transport options ("http_pool_size" and
+# "http2").
+class LvsSession(requests.Session):
+    def __init__(self):
+        super().__init__()
+        request_layer.configure_session(self)
+
+    def request(
+        self, method, url, *args, idempotent=None, retry_server_errors=True, **kwargs
+    ):
+        if idempotent is None:
+            idempotent = method.upper() in ("GET", "HEAD", "OPTIONS")
+        return request_layer.controlled_call(
+            request_layer.host_of_url(url),
+            lambda: requests.Session.request(self, method, url, *args, **kwargs),
+            idempotent=idempotent,
+            retry_server_errors=retry_server_errors,
+        )
+
+
+session_store_fname = "sessions.json"
+
+
+def export_lvs_session(s):
+    cookies = [
+        {
+            "name": c.name,
+            "value": c.value,
+            "domain": c.domain,
+            "path": c.path,
+            "expires": c.expires,
+            "secure": c.secure,
+        }
+        for c in s.cookies
+    ]
+    return {
+        "cookies": cookies,
+        "open_modules": sorted(getattr(s, "lvs_open_modules", set())),
+    }
+
+
+def import_lvs_session(data):
+    s = LvsSession()
+    for c in data["cookies"]:
+        s.cookies.set(
+            c["name"],
+            c["value"],
+            domain=c["domain"],
+            path=c["path"],
+            expires=c["expires"],
+            secure=c["secure"],
+        )
+    s.lvs_open_modules = set(data["open_modules"])
+    return s
+
+
+# The expiry of the JWT if given, else of its cookie, else a default.
+def get_lvs_session_expiry(s):
+    exp = get_jwt_payload(s).get("exp")
+    if exp:
+        return exp
+    for c in s.cookies:
+        if c.name == "JWT-LVS" and c.expires:
+            return c.expires
+    return time.time() + session_store.default_max_age
+
+
+# A cheap request (the groups list, needed by most programs anyway) to check that the website
+# still accepts the session.
+def is_valid_lvs_session(s):
+    try:
+        r = s.post(
+            get_url("get_groups"), json={"idprof": get_teacher_id(s)}, idempotent=True
+        )
+        r.json()
+    except (RuntimeError, ValueError, requests.RequestException) as e:
+        logging.debug(f"Stored session check failed: {e}")
+        return False
+    return r.ok and not is_login_redirect(r)
+
+
+# Returns the session stored for user, or None if there is none or it is not valid anymore.
+def restore_lvs_session(session_store_fname, user, password):
+    data = session_store.load_session_data(
+        session_store_fname, get_base_url(), user, password
+    )
+    if data is None:
+        return None
+    s = import_lvs_session(data)
+    if not is_valid_lvs_session(s):
+        s.close()
+        session_store.forget_session_data(session_store_fname, get_base_url(), user)
+        return None
+    return s
+
+
+def save_lvs_session(s):
+    if not "JWT-LVS" in s.cookies:
+        return
+    session_store_fname, user, password = s.lvs_session_store
+    session_store.save_session_data(
+        session_store_fname,
+        get_base_url(),
+        user,
+        password,
+        export_lvs_session(s),
+        get_lvs_session_expiry(s),
+    )
+
+
 # The login_url is ignored for the LVS backend.
+# With session_store_fname, the session is kept in this file (see session_store), and the login is
+# skipped if a valid session is found there.
+# The other arguments of open_session_from_args are for the pronote backend only.
 @pronote.reimplemented
-def open_session(user, password, login_url):
+def open_session(user, password, login_url, session_store_fname=None, **kwargs):
     if user is None:
         user = input("Username:\n")
     if password is None:
         password = input_password("Password:\n")
+    if session_store_fname:
+        s = restore_lvs_session(session_store_fname, user, password)
+        if s is not None:
+            print("Using stored session")
+            s.lvs_session_store = (session_store_fname, user, password)
+            return s
     json_payload = json.loads("{}")
     json_payload["externalentpersjointure"] = None
     json_payload["login"] = user
     json_payload["password"] = password
     try:
-        s = requests.Session()
+        s = LvsSession()
         r = s.post(get_url("connexion"), json=json_payload)
     except Exception as e:
         raise RuntimeError(f"Connexion error: \n{e}")
@@ -337,6 +580,9 @@ def open_session(user, password, login_url):
     if not json_response["auth"] == "ok":
         raise RuntimeError("Authentification failure")
     print("Authentification success")
+    if session_store_fname:
+        s.lvs_session_store = (session_store_fname, user, password)
+        save_lvs_session(s)
     return s
 
 
@@ -353,50 +599,177 @@ def open_session_from_args(args):
     ]
     d = {k: args[k] for k in needed_args if k in args}
     d["update_config_file_fun"] = update_config_file
+    if args.get("session_store"):
+        d["session_store_fname"] = get_cache_fname(session_store_fname)
     s = open_session(**d)
     return s
 
 
 @pronote.reimplemented
 def close_session(s):
+    # Keep the modules opened (and cookies received) during the run
+    if hasattr(s, "lvs_session_store"):
+        save_lvs_session(s)
     return s.close()
 
 
+# Some parts of the website (modules, like "absences") need a handshake before their pages can be
+# used, else they answer with a 500 error: getModuleUrl gives a "/vsn.main/main/externalOpen" url
+# with an "extautolog" encrypted parameter, which redirects to the module, then the module start
+# page must be requested.
+# The open modules are remembered in the session (see module_request).
+@pronote.notimplemented
+def open_module(s, module, force=False):
+    if not hasattr(s, "lvs_open_modules"):
+        s.lvs_open_modules = set()
+    if module in s.lvs_open_modules and not force:
+        return
+    mod, start_url_name, start_params = modules[module]
+    # Same value as javascript's getTimezoneOffset, for example -120 for UTC+2.
+    utc_offset = datetime.datetime.now().astimezone().utcoffset()
+    params = {
+        "mod": mod,
+        "minuteEcartGMTClient": -int(utc_offset.total_seconds() // 60),
+    }
+    r = s.post(get_url("get_module_url"), params=params, idempotent=True)
+    r.raise_for_status()
+    r = s.get(json.loads(r.text)["location"])  # redirects
+    r.raise_for_status()
+    r = s.get(get_url(start_url_name), params=start_params)
+    r.raise_for_status()
+    s.lvs_open_modules.add(module)
+
+
+def is_login_redirect(r):
+    return bool(r.history) and r.url.split("?")[0].endswith(urls["login"])
+
+
+# Same as s.request(method, url, **kwargs), for a page of a module. The module is opened first if
+# needed, and opened again (once) if the website answers with a 500 error or a redirect to login.
+# Does not call raise_for_status.
+def module_request(s, module, method, url, **kwargs):
+    open_module(s, module)
+    # A 500 error here means that the module must be opened again, not that the website fails.
+    r = s.request(method, url, retry_server_errors=False, **kwargs)
+    if r.status_code == 500 or is_login_redirect(r):
+        logging.debug(f"Opening module {module} again after response {r.status_code}")
+        open_module(s, module, force=True)
+        r = s.request(method, url, **kwargs)
+    return r
+
+
+# Returns a new session sharing the cookies (and so the login) of s.
+# requests.Session objects are not guaranteed to be thread safe, so each worker thread should use its own.
+@pronote.notimplemented
+def clone_session(s):
+    s2 = LvsSession()
+    s2.headers.update(s.headers)
+    s2.cookies.update(s.cookies)
+    # Modules opened in s are open for the same cookies
+    s2.lvs_open_modules = set(getattr(s, "lvs_open_modules", set()))
+    return s2
+
+
+# Yields fun(s, arg) for each arg of arg_list, in the order of arg_list.
+# With jobs > 1, the calls are made by a pool of jobs worker threads, each with its own clone of s.
+# The pronote backend can not clone its sessions, so the calls are then always made one after the
+# other.
+def map_with_sessions(s, fun, arg_list, jobs=1):
+    if jobs is None or jobs <= 1 or pronote.__is_pronote_backend__:
+        for arg in arg_list:
+            yield fun(s, arg)
+        return
+    local = threading.local()
+    worker_sessions = []
+    lock = threading.Lock()
+
+    def worker(arg):
+        if not hasattr(local, "s"):
+            local.s = clone_session(s)
+            with lock:
+                worker_sessions.append(local.s)
+        return fun(local.s, arg)
+
+    try:
+        with concurrent.futures.ThreadPoolExecutor(max_workers=jobs) as executor:
+            # executor.map gives results in order, whatever the order of completion.
+            for result in executor.map(worker, arg_list):
+                yield result
+    finally:
+        for ws in worker_sessions:
+            ws.close()
+
+
 @pronote.reimplemented
 def request_default_period(s):
     raise Notimplemented
 
 
+# Returns a BeautifulSoup object containing only the elements matching name and attrs (with the
+# same arguments as soup.find_all), which is much faster to build than the whole page.
+# If nothing matches, falls back to parsing the whole page with "html.parser" (the result can then
+# be used for the same searches, and for error messages).
+def parse_html_only(html, name=None, **attrs):
+    try:
+        soup = BeautifulSoup(html, html_parser, parse_only=SoupStrainer(name, **attrs))
+        if soup.find_all(name, **attrs):
+            return soup
+    except Exception as e:
+        logging.debug(f"Partial parsing failed, parsing the whole page: {e}")
+    return BeautifulSoup(html, "html.parser")
+
+
 def base64_pad(s):
     pad = len(s) % 4
     return s + "=" * pad
 
 
-@pronote.notimplemented
-# This id is needed in some requests, and only given through the initial session cookie.
-def get_teacher_id(s):
+def get_jwt_payload(s):
     if not "JWT-LVS" in s.cookies:
         raise RuntimeError("Session error: No JWT in cookies.")
     cs = s.cookies["JWT-LVS"]
     payload64 = cs.split(".")[1]
     payload = base64.b64decode(base64_pad(payload64))
-    payload_json = json.loads(payload)
+    return json.loads(payload)
+
+
+@pronote.notimplemented
+# This id is needed in some requests, and only given through the initial session cookie.
+def get_teacher_id(s):
+    payload_json = get_jwt_payload(s)
     if not "pid" in payload_json:
         raise RuntimeError("Session error: No pid in JWT cookie.")
     teacher_id = payload_json["pid"]
     return teacher_id
 
 
+response_cache_fname = "responses.json"
+
+
+# Identifies the website and user for response_cache.
+@pronote.reimplemented
+def get_cache_scope(s):
+    return f"{get_base_url()} {get_teacher_id(s)}"
+
+
+# Returns the json response of a post (which only reads data) to the url named url_name, through
+# response_cache.
+def cached_json_post(s, url_name, json_payload):
+    def fetch():
+        r = s.post(get_url(url_name), json=json_payload, idempotent=True)
+        r.raise_for_status()
+        return r.json()
+
+    return response_cache.cached_read(get_cache_scope(s), url_name, json_payload, fetch)
+
+
 @pronote.reimplemented
 def get_groups(s):
     teacher_id = get_teacher_id(s)
-    url = get_url("get_groups")
     payload = '{"idprof":0}'
     json_payload = json.loads(payload)
     json_payload["idprof"] = teacher_id
-    r = s.post(url, json=json_payload)
-    r.raise_for_status()
-    json_groups = r.json()
+    json_groups = cached_json_post(s, "get_groups", json_payload)
     return json_groups
 
 
@@ -643,6 +1016,18 @@ def get_trimester_from_json(json_groups):
     return default_t
 
 
+# Returns the school year of a date (default today), like "2021-2022".
+def get_school_year_s(date_ymd=None):
+    if date_ymd is None:
+        d = datetime.date.today()
+    else:
+        d = datetime.date.fromisoformat(date_ymd)
+    # Same threshold as in guess_trimester_from_date
+    if d < datetime.date(d.year, 8, 1):
+        return f"{d.year - 1}-{d.year}"
+    return f"{d.year}-{d.year + 1}"
+
+
 # This is pure heuristic and should not be trusted.
 # The dates choosen for trimester threshold vary per year and school; an arbitrary choice was made.
 def guess_trimester_from_date(date_ymd=None):
@@ -678,29 +1063,23 @@ def grade_parse(grade):
 
 @pronote.reimplemented
 def get_grades(s, service_id, trimester):
-    url = get_url("get_grades")
     payload = '{"serviceId":0,"periodeId":0,"devoirId":null,"profId":0}'
     json_payload = json.loads(payload)
     teacher_id = get_teacher_id(s)
     json_payload["periodeId"] = trimester
     json_payload["profId"] = teacher_id
     json_payload["serviceId"] = service_id
-    r = s.post(url, json=json_payload)
-    r.raise_for_status()
-    json_grades = r.json()
+    json_grades = cached_json_post(s, "get_grades", json_payload)
     return json_grades
 
 
 @pronote.reimplemented
 def get_apprs(s, service_id, trimester):
-    url = get_url("get_apprs")
     payload = '{"idService":0,"idPeriode":0}'
     json_payload = json.loads(payload)
     json_payload["idService"] = service_id
     json_payload["idPeriode"] = trimester
-    r = s.post(url, json=json_payload)
-    r.raise_for_status()
-    json_apprs = r.json()
+    json_apprs = cached_json_post(s, "get_apprs", json_payload)
     return json_apprs
 
 
@@ -802,7 +1181,7 @@ def get_mess_dest_json(s, dest_search_s, dest_type="student"):
             f"Incorrect destinatory type (should be in {list(dest_type.keys())})"
         )
     json_payload_dest_search["profils"][0] = dest_types[dest_type]
-    r = s.post(get_url("dest"), json=json_payload_dest_search)
+    r = s.post(get_url("dest"), json=json_payload_dest_search, idempotent=True)
     r.raise_for_status()
     json_dest_search_res = r.json()
     if len(json_dest_search_res) < 1:
@@ -943,22 +1322,44 @@ def match_students_to_rows(s, csv_fname, json_grades=None, student_names_of_ids=
     if student_names_of_ids is None:
         assert not json_grades is None
         student_names_of_ids = get_student_names_of_ids(json_grades)
-    id_of_names = {student_names_of_ids[i]: i for i in student_names_of_ids.keys()}
-    not_matched_csv = []
+    # Names are matched ignoring accents, case and whitespace differences.
+    name_index = pronote.build_name_index(student_names_of_ids)
+    # dict of student_name : list of student_id, for the exact matches, tried first
+    student_ids_of_name = {}
+    for student_id, student_name in student_names_of_ids.items():
+        student_ids_of_name.setdefault(student_name, []).append(student_id)
     rows = student_rows_of_csv_rows(rows)
+    rows_to_match = []
     for row in rows:
         csv_name = row[0]
-        if csv_name in id_of_names:
-            student_id = id_of_names[csv_name]
-            row_of_student_id[student_id] = row
-            del id_of_names[csv_name]
+        if re.search("[0-9]", csv_name):
+            # If the "name" contains a digit, it's probably not a name;
+            # don't count it as unmatched
+            continue
+        rows_to_match.append(row)
+    rows_left = []
+    for row in rows_to_match:
+        student_ids = [
+            student_id
+            for student_id in student_ids_of_name.get(row[0], [])
+            if not student_id in row_of_student_id
+        ]
+        if len(student_ids) != 1:
+            student_ids = [
+                student_id
+                for student_id in pronote.find_in_name_index(name_index, row[0])
+                if not student_id in row_of_student_id
+            ]
+        if len(student_ids) == 1:
+            row_of_student_id[student_ids[0]] = row
         else:
-            if re.search("[0-9]", csv_name):
-                # If the "name" contains a digit, it's probably not a name;
-                # don't count it as unmatched
-                continue
-            not_matched_csv.append(csv_name)
-    not_matched_website = list(id_of_names.keys())
+            rows_left.append(row)
+    not_matched_csv = [row[0] for row in rows_left]
+    not_matched_website = [
+        student_name
+        for student_id, student_name in student_names_of_ids.items()
+        if not student_id in row_of_student_id
+    ]
     print("Matched ", len(row_of_student_id), " students from website to csv.")
     error_flag = False
     if not_matched_website:
@@ -973,7 +1374,18 @@ def match_students_to_rows(s, csv_fname, json_grades=None, student_names_of_ids=
         print("Warning: Not all lines from csv matched to names on the website")
         print("*** Lines from csv not matched:")
         for name in not_matched_csv:
-            print(name)
+            # Near matches are only suggested: the student might not be on the website at all.
+            suggestions = [
+                student_names_of_ids[student_id]
+                for student_id in pronote.find_in_name_index(
+                    name_index, name, near=True
+                )
+                if not student_id in row_of_student_id
+            ]
+            if suggestions:
+                print(f'{name} (did you mean "{suggestions[0]}"?)')
+            else:
+                print(name)
         print("***")
     return (error_flag, row_of_student_id)
 
@@ -56,6 +56,7 @@ def send_apprs_dopost(
         print("Uploading: " + student_name)
         r = s.post(url, json=json_payload)
         r.raise_for_status()
+    response_cache.invalidate(get_cache_scope(s), ["get_apprs"])
 
 
 def send_apprs(
@@ -8,6 +8,8 @@ Send grades from csv file to the website.
 
 from lvs_module import *
 
+import glob
+
 add_url("send_grades", "/vsn.main/WSCompetences/saveBatchEvaluations")
 add_url("create_evaluation", "/vsn.main/WSCompetences/creerEvaluation")
 add_url("modify_evaluation", "/vsn.main/WSCompetences/modifierDevoir")
@@ -76,6 +78,7 @@ def create_evaluation(s, service_id, trimester, evaluation_name, desc, hidden=Fa
     print("Creating", evaluation_name)
     r = s.post(url, json=json_payload)
     r.raise_for_status()
+    response_cache.invalidate(get_cache_scope(s), ["get_grades"])
     json_created = r.json()
     evaluation_id = json_created["id"]
     desc_full = desc + (evaluation_id,)
@@ -125,6 +128,7 @@ def modify_evaluation_desc(
     print("Modifying max grade or coefficient for", evaluation_name)
     r = s.post(get_url("modify_evaluation"), json=json_payload)
     r.raise_for_status()
+    response_cache.invalidate(get_cache_scope(s), ["get_grades"])
 
 
 # returns a dict of evaluation_name : (col, max_grade, coefficient, evaluation_id)
@@ -203,12 +207,8 @@ def get_evaluation_id_and_create_evaluations(
             f"Found {len(evaluations_not_in_website)} evaluation(s) not present on the website: {', '.join(evaluations_not_in_website)}"
         )
         if create_evaluations:
-            first_it = True
+            # Requests are paced by the session (see request_layer)
             for evaluation_name in evaluations_not_in_website:
-                if first_it:
-                    first_it = False
-                else:
-                    time.sleep(0.1)
                 desc = evaluation_descs[evaluation_name]
                 desc_full = create_evaluation(
                     s, service_id, trimester, evaluation_name, desc, hidden=hidden
@@ -227,12 +227,7 @@ def get_evaluation_id_and_create_evaluations(
             dialog_s = f"Upload the modified max grades and coefficients? ({len(evaluations_with_new_desc)} evaluation(s) will be modified.)"
             answer = input_Yn(dialog_s)
             if answer:
-                first_it = True
                 for evaluation_name in evaluations_with_new_desc:
-                    if first_it:
-                        first_it = False
-                    else:
-                        time.sleep(0.1)
                     (col, max_grade, coefficient) = evaluation_descs[evaluation_name]
                     modify_evaluation_desc(
                         s,
@@ -274,24 +269,30 @@ def send_grades_dopost(s, trimester, json_grades, service_id, new_grades_dict):
     url = get_url("send_grades")
     r = s.post(url, json=json_payload)
     r.raise_for_status()
+    response_cache.invalidate(get_cache_scope(s), ["get_grades"])
 
 
-def send_grades(
+# Downloads the grades of the group, creates the evaluations if needed, and compares the grades of
+# the csv file with those of the website.
+# Returns a dict with the arguments of send_grades_dopost ("trimester", "json_grades", "service_id"
+# and "new_grades_dict"), and "write_count", "overwrite_count" and "delete_count".
+def prepare_grades_upload(
     s,
     csv_fname,
     trimester,
     group_name,
     create_evaluations=False,
     hidden=False,
-    ask_to_write=True,
-    never_write=False,
-    ask_to_delete=True,
     never_delete=False,
+    json_groups=None,
+    json_grades=None,
 ):
     evaluation_descs = get_evaluations_from_csv(csv_fname)
-    json_groups = get_groups(s)
+    if json_groups is None:
+        json_groups = get_groups(s)
     service_id = get_service_id(group_name, json_groups)
-    json_grades = get_grades(s, service_id, trimester)
+    if json_grades is None:
+        json_grades = get_grades(s, service_id, trimester)
 
     created_flag, evaluation_descs_full = get_evaluation_id_and_create_evaluations(
         s,
@@ -374,12 +375,32 @@ def send_grades(
             )
             print(students_preview(student_names, delete_list))
             delete_count += len(delete_list)
+    return {
+        "trimester": trimester,
+        "json_grades": json_grades,
+        "service_id": service_id,
+        "new_grades_dict": new_grades_dict,
+        "write_count": write_count,
+        "overwrite_count": overwrite_count,
+        "delete_count": delete_count,
+    }
+
+
+# Returns True if the grades should be uploaded (asking the user if needed).
+def confirm_grades_upload(
+    write_count,
+    overwrite_count,
+    delete_count,
+    ask_to_write=True,
+    never_write=False,
+    ask_to_delete=True,
+):
     if write_count == 0:
         print("No grades need to be uploaded.")
-        return
+        return False
     if never_write:
         print("Not uploading as per option.")
-        return
+        return False
     dialog_s = ""
     if delete_count + overwrite_count > 0 and ask_to_delete:
         dialog_s += "Uploading grades will "
@@ -400,10 +421,174 @@ def send_grades(
                 print(
                     "You can upload grades without deleting existing ones with the --no-delete option."
                 )
-            return
+            return False
+    return True
+
+
+def send_grades(
+    s,
+    csv_fname,
+    trimester,
+    group_name,
+    create_evaluations=False,
+    hidden=False,
+    ask_to_write=True,
+    never_write=False,
+    ask_to_delete=True,
+    never_delete=False,
+):
+    upload = prepare_grades_upload(
+        s,
+        csv_fname,
+        trimester,
+        group_name,
+        create_evaluations=create_evaluations,
+        hidden=hidden,
+        never_delete=never_delete,
+    )
+    if not confirm_grades_upload(
+        upload["write_count"],
+        upload["overwrite_count"],
+        upload["delete_count"],
+        ask_to_write=ask_to_write,
+        never_write=never_write,
+        ask_to_delete=ask_to_delete,
+    ):
+        return
     print("Uploading...")
     # Actual uploading
-    send_grades_dopost(s, trimester, json_grades, service_id, new_grades_dict)
+    send_grades_dopost(
+        s,
+        upload["trimester"],
+        upload["json_grades"],
+        upload["service_id"],
+        upload["new_grades_dict"],
+    )
+
+
+# Returns the list of csv files in a directory, or matching a glob pattern.
+def get_batch_csv_fnames(path):
+    if os.path.isdir(path):
+        fnames = [os.path.join(path, fname) for fname in os.listdir(path)]
+    else:
+        fnames = glob.glob(path)
+    csv_fnames = sorted(
+        [fname for fname in fnames if os.path.isfile(fname) and is_csv_filename(fname)]
+    )
+    if not csv_fnames:
+        raise RuntimeError(f"No csv file found for {path}.")
+    return csv_fnames
+
+
+# Same as send_grades for several csv files, with a single session, a single get_groups and a
+# single confirmation for all the files.
+# The group of each file is read from the file, and its trimester from the file name (or
+# trimester if given).
+# With jobs > 1, the grades of the groups are downloaded (and their missing evaluations created),
+# and then uploaded, concurrently. The comparison with the csv files is done one group after the
+# other, as it can ask the user and its output must stay grouped by file.
+def send_grades_batch(
+    s,
+    csv_fnames,
+    trimester=None,
+    jobs=1,
+    create_evaluations=False,
+    hidden=False,
+    ask_to_write=True,
+    never_write=False,
+    ask_to_delete=True,
+    never_delete=False,
+):
+    json_groups = get_groups(s)
+    # Files grouped by (group name, trimester), as each upload is compared with the website grades.
+    # (The service_id can not be used as a key: it is a dict for pronote.)
+    csv_fname_of_key = {}
+    batch = []
+    for csv_fname in csv_fnames:
+        group_name = get_group_name_from_csv(csv_fname)
+        file_trimester = trimester
+        if file_trimester is None:
+            file_trimester = get_trimester_from_csv_fname(csv_fname)
+        key = (group_name, file_trimester)
+        if key in csv_fname_of_key:
+            raise RuntimeError(
+                f"Files {csv_fname_of_key[key]} and {csv_fname} are for the same group and trimester."
+            )
+        csv_fname_of_key[key] = csv_fname
+        service_id = get_service_id(group_name, json_groups)
+        batch.append((csv_fname, group_name, file_trimester, service_id))
+
+    # Returns the grades of the group, and the names of the evaluations created.
+    def download_group(s, batch_item):
+        csv_fname, group_name, file_trimester, service_id = batch_item
+        json_grades = get_grades(s, service_id, file_trimester)
+        created_names = []
+        if create_evaluations:
+            website_descs = get_evaluation_website_descs(json_grades)
+            for evaluation_name, desc in get_evaluations_from_csv(csv_fname).items():
+                if not evaluation_name in website_descs:
+                    create_evaluation(
+                        s,
+                        service_id,
+                        file_trimester,
+                        evaluation_name,
+                        desc,
+                        hidden=hidden,
+                    )
+                    created_names.append(evaluation_name)
+            # Redownload grades after creating a evaluation (as in prepare_grades_upload)
+            if created_names:
+                json_grades = get_grades(s, service_id, file_trimester)
+        return json_grades, created_names
+
+    uploads = []
+    for (csv_fname, group_name, file_trimester, _), (
+        json_grades,
+        created_names,
+    ) in zip(batch, map_with_sessions(s, download_group, batch, jobs=jobs)):
+        print(f"*** {csv_fname} ({group_name}, trimester {file_trimester})")
+        if created_names:
+            print(
+                f"Created {len(created_names)} evaluation(s): {', '.join(created_names)}. Note that their creation date has been set to today."
+            )
+        upload = prepare_grades_upload(
+            s,
+            csv_fname,
+            file_trimester,
+            group_name,
+            create_evaluations=create_evaluations,
+            hidden=hidden,
+            never_delete=never_delete,
+            json_groups=json_groups,
+            json_grades=json_grades,
+        )
+        if upload["write_count"] > 0:
+            uploads.append((group_name, upload))
+    print("***")
+    if not confirm_grades_upload(
+        sum([upload["write_count"] for _, upload in uploads]),
+        sum([upload["overwrite_count"] for _, upload in uploads]),
+        sum([upload["delete_count"] for _, upload in uploads]),
+        ask_to_write=ask_to_write,
+        never_write=never_write,
+        ask_to_delete=ask_to_delete,
+    ):
+        return
+
+    def upload_group(s, group_name_and_upload):
+        group_name, upload = group_name_and_upload
+        send_grades_dopost(
+            s,
+            upload["trimester"],
+            upload["json_grades"],
+            upload["service_id"],
+            upload["new_grades_dict"],
+        )
+        return group_name
+
+    print("Uploading...")
+    for group_name in map_with_sessions(s, upload_group, uploads, jobs=jobs):
+        print(f"Uploaded {group_name}")
 
 
 def main():
@@ -418,6 +603,22 @@ def main():
                     "help": 'The csv file in which grades will be read. Can be omitted if there is only one csv file in the working directory. The program expects the file to be in the format exported by the website. In particular, evaluation names should be on the first line, with the cell below each name describing the maximum grade and grade multiplier as in the following: "/10 - Coef : 0.5".',
                 },
             ),
+            (
+                ("--batch",),
+                {
+                    "metavar": "DIR_OR_GLOB",
+                    "help": 'Upload all the csv files of a directory, or matching a pattern like "exports/*.csv" (in quotes). The group of each file is read from the file, and its trimester from the file name (unless -t is given). A single confirmation is asked for all the files.',
+                },
+            ),
+            (
+                ("--jobs",),
+                {
+                    "metavar": "N",
+                    "type": int,
+                    "default": 1,
+                    "help": "With --batch, number of groups to download and upload at the same time. Default is 1 (one group after the other).",
+                },
+            ),
             #            (('-e', '--evaluation'), {
             #                        'help':'If provided, only this evaluation (evaluation) will be modified on the website.'}),
             (
@@ -455,7 +656,17 @@ def main():
             shared_args=shared_args,
             description="Upload grades from a csv file to a specific axess website.",
             required=["csv_fname"],
+            # Processed below, as they are not used in batch mode
+            dont_process=["csv_fname", "group", "trimester"],
         )
+        if args["batch"]:
+            if args["csv_fname"] or args["group_name"]:
+                raise RuntimeError(
+                    "A csv file or a group name cannot be given with --batch."
+                )
+            csv_fnames = get_batch_csv_fnames(args["batch"])
+        else:
+            process_csv_args(args, required=["csv_fname"])
         if args["write"] is None:
             args["ask_to_write"] = True
             args["never_write"] = False
@@ -475,6 +686,20 @@ def main():
         if args["hidden"] is None:
             args["hidden"] = False
         s = open_session_from_args(args)
+        if args["batch"]:
+            send_grades_batch(
+                s,
+                csv_fnames,
+                trimester=args["trimester"],
+                jobs=args["jobs"],
+                create_evaluations=args["create"],
+                hidden=args["hidden"],
+                ask_to_write=args["ask_to_write"],
+                never_write=args["never_write"],
+                ask_to_delete=args["ask_to_delete"],
+                never_delete=args["never_delete"],
+            )
+            return
         send_grades(
             s,
             args["csv_fname"],
@@ -0,0 +1,26 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Writing of the json files kept by the programs in the user dirs (caches, sessions), which can hold
+personal data (see write_private_json, used by lvs_module, response_cache and session_store).
+"""
+
+import json
+import os
+
+
+# Writes j to the file ffname (creating its dir if needed), readable only by the user.
+# The file is replaced at once, as other runs might be reading it.
+# Raises OSError (for example PermissionError) if the file can not be written.
+def write_private_json(ffname, j):
+    os.makedirs(os.path.dirname(ffname), exist_ok=True)
+    tmp_ffname = f"{ffname}.{os.getpid()}.tmp"
+    fd = os.open(tmp_ffname, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+    try:
+        with os.fdopen(fd, "w") as f:
+            json.dump(j, f)
+        os.replace(tmp_ffname, ffname)
+    except BaseException:
+        if os.path.exists(tmp_ffname):
+            os.remove(tmp_ffname)
+        raise
@@ -8,6 +8,8 @@ Provides reimplementations for the pronote backend of functions from the lvs mod
 
 The "initialize" function must be run before any calls to the reimplemented functions. If not (or if the backend is not detected or set to be pronote), the base functions will be run.
 
+The backend is chosen once by "initialize", which binds each decorated function to its implementation (see set_backend). Tests can bind them to another Backend, for example a mock one.
+
 To make it transparent to the calling module, the functions take the same argument in the same order. However, the content (and often type) of those arguments are different. In particular:
 - The LVS backend uses a request.session called "s". In pronote this will actually be a pronote_py.Client object, called "client" by the pronote version.  
 - The LVS backend uses "service_id" value. In pronote this will be a "group_data" json object.
@@ -15,7 +17,15 @@ To make it transparent to the calling module, the functions take the same argume
 
 import re
 import functools
+import threading
 import random
+import time
+import logging
+import unicodedata
+
+import request_layer
+import response_cache
+import session_store
 
 # Should not be set manualy
 __is_pronote_backend__ = None
@@ -24,6 +34,54 @@ ent_modules = []
 
 # See functions cache_possible_recipients and clear_possible_recipients_cache
 cached_possible_recipient_data_list = None
+cached_possible_recipient_name_index = None
+
+
+# Implementation of the functions decorated with reimplemented or notimplemented in the lvs
+# modules (see set_backend).
+# functions: dict of function name : function, for the functions replaced by this backend.
+# lvs_fallback: if True, the other functions run as defined in the lvs modules, and the functions
+# decorated with notimplemented can be replaced too (for example by a mock backend for tests).
+# If False, the other functions raise an error.
+class Backend:
+    def __init__(self, name, functions, lvs_fallback=False):
+        self.name = name
+        self.functions = functions
+        self.lvs_fallback = lvs_fallback
+
+    # kind is "reimplemented" or "notimplemented"
+    def resolve(self, func, kind):
+        name = func.__name__
+        if self.lvs_fallback:
+            return self.functions.get(name, func)
+        if kind == "reimplemented" and name in self.functions:
+            return self.functions[name]
+
+        def not_implemented(*args, **kwargs):
+            raise RuntimeError(f"{name}: not implemented for {self.name}")
+
+        return not_implemented
+
+
+lvs_backend = Backend("lvs", {}, lvs_fallback=True)
+# The functions of this module named as the reimplemented functions.
+pronote_backend = Backend("pronote", globals())
+
+backend = lvs_backend
+# list of (binding, func, kind) for each decorated function, binding being the one element list
+# holding the function called by its wrapper.
+dispatch_table = []
+dispatch_table_lock = threading.Lock()
+
+
+# Binds all the decorated functions to the functions of new_backend, so that the calls do not
+# need any lookup.
+def set_backend(new_backend):
+    global backend
+    with dispatch_table_lock:
+        backend = new_backend
+        for binding, func, kind in dispatch_table:
+            binding[0] = backend.resolve(func, kind)
 
 
 # Should not be called manualy
@@ -36,6 +94,9 @@ def set_is_pronote_backend(value):
 
         global ent_modules
         ent_modules = [pronotepy_monlycee, pronotepy.ent, pronotepy.ent.complex_ent]
+        set_backend(pronote_backend)
+    else:
+        set_backend(lvs_backend)
 
 
 # Must be called first
@@ -52,30 +113,27 @@ def initialize(login_url=None, is_pronote_backend=None):
         set_is_pronote_backend(is_valid_url)
 
 
-# Use this decorator in lvs modules for functions reimplemented here.
-def reimplemented(func):
+def dispatched(func, kind):
+    with dispatch_table_lock:
+        binding = [backend.resolve(func, kind)]
+        dispatch_table.append((binding, func, kind))
+
     @functools.wraps(func)
     def wrapper(*args, **kwargs):
-        # if None or False, no reimplementation occurs
-        if __is_pronote_backend__ != True:
-            return func(*args, **kwargs)
-        else:
-            return globals()[func.__name__](*args, **kwargs)
+        return binding[0](*args, **kwargs)
 
     return wrapper
 
 
+# Use this decorator in lvs modules for functions reimplemented here.
+# Until initialize is called, the lvs function is run.
+def reimplemented(func):
+    return dispatched(func, "reimplemented")
+
+
 # Use this decorator in lvs modules for functions that should not be called in the case of a pronote backend.
 def notimplemented(func):
-    @functools.wraps(func)
-    def wrapper(*args, **kwargs):
-        # if None or False, proceed as normal
-        if __is_pronote_backend__ != True:
-            return func(*args, **kwargs)
-        else:
-            raise RuntimeError(f"{func.__name__}: not implemented for pronote")
-
-    return wrapper
+    return dispatched(func, "notimplemented")
 
 
 # reimplementation
@@ -115,8 +173,105 @@ def get_response_data(r, key=None):
     return d[key]["V"]
 
 
-def find_in_data(data_list, key=None, substr=False, exactly_one=False, **kwargs):
+# Returns name in lower case, without accents, and with runs of whitespace, hyphens and apostrophes
+# replaced by a single space, so that "DUPONT  Zoé-Anne" and "Dupont Zoe Anne" are equal.
+def normalize_name(name):
+    name = unicodedata.normalize("NFKD", name)
+    name = "".join([c for c in name if not unicodedata.combining(c)])
+    return " ".join(re.split(r"[\s\-'’]+", name.casefold())).strip()
+
+
+def name_trigrams(normalized_name):
+    padded = f"  {normalized_name} "
+    return {padded[i : i + 3] for i in range(len(padded) - 2)}
+
+
+# A name index is built once for many lookups (see find_in_name_index).
+# names_of_keys is a dict of key : name (or a list of names, the keys then being the positions).
+# Returns a dict with:
+# "names": dict of key : normalized name
+# "exact": dict of normalized name : list of keys
+# "trigrams": dict of trigram : set of keys
+def build_name_index(names_of_keys):
+    if isinstance(names_of_keys, list):
+        names_of_keys = dict(enumerate(names_of_keys))
+    index = {"names": {}, "exact": {}, "trigrams": {}}
+    for key, name in names_of_keys.items():
+        normalized_name = normalize_name(name)
+        index["names"][key] = normalized_name
+        index["exact"].setdefault(normalized_name, []).append(key)
+        for trigram in name_trigrams(normalized_name):
+            index["trigrams"].setdefault(trigram, set()).add(key)
+    return index
+
+
+# Minimum similarity (Sørensen–Dice coefficient over trigrams) for a near match.
+near_match_threshold = 0.8
+
+
+# Returns the list of keys (in index order) whose name matches name, ignoring accents, case and
+# whitespace differences. With substr, name can be part of the matching names.
+# If nothing matches and near is True, returns the key of the most similar name (if it is similar
+# enough and is the only one with that similarity).
+def find_in_name_index(index, name, substr=False, near=False):
+    normalized_name = normalize_name(name)
+    if normalized_name in index["exact"]:
+        if not substr:
+            return list(index["exact"][normalized_name])
+    if substr:
+        # Any name containing normalized_name contains its (unpadded) trigrams
+        inner_trigrams = {
+            normalized_name[i : i + 3] for i in range(len(normalized_name) - 2)
+        }
+        candidates = set(index["names"].keys())
+        for trigram in inner_trigrams:
+            candidates &= index["trigrams"].get(trigram, set())
+        keys = [
+            key
+            for key in index["names"]
+            if key in candidates and normalized_name in index["names"][key]
+        ]
+        if keys:
+            return keys
+    if not near:
+        return []
+    trigrams = name_trigrams(normalized_name)
+    shared_counts = {}
+    for trigram in trigrams:
+        for key in index["trigrams"].get(trigram, set()):
+            shared_counts[key] = shared_counts.get(key, 0) + 1
+    scores = {
+        key: 2 * count / (len(trigrams) + len(name_trigrams(index["names"][key])))
+        for key, count in shared_counts.items()
+    }
+    if not scores:
+        return []
+    best_score = max(scores.values())
+    best_keys = [key for key, score in scores.items() if score == best_score]
+    if best_score < near_match_threshold or len(best_keys) != 1:
+        return []
+    return best_keys
+
+
+# Returns the name index of the "L" attributes of data_list. To be built once by the caller for
+# many lookups in the same data_list.
+def get_name_index(data_list):
+    return build_name_index([data.get("L", "") for data in data_list])
+
+
+# With name_index (see get_name_index) and an "L" filter, the names are looked up in the index
+# (ignoring accents, case and whitespace differences) instead of compared one by one.
+# Near matches are never used here, as the results are used to write to the website.
+def find_in_data(
+    data_list, key=None, substr=False, exactly_one=False, name_index=None, **kwargs
+):
     output = []
+    if name_index is not None and "L" in kwargs:
+        data_list = [
+            data_list[i]
+            for i in find_in_name_index(name_index, kwargs["L"], substr=substr)
+        ]
+        kwargs = {attr: value for attr, value in kwargs.items() if attr != "L"}
     for data in data_list:
         for attr in kwargs:
             if not attr in data:
@@ -148,6 +303,36 @@ def union_dict(d1, d2):
     return d
 
 
+# reimplementation
+def get_cache_scope(client):
+    return f"{client.pronote_url} {client.username}"
+
+
+# Same as client.post, through request_layer (limits, retries if idempotent, circuit breaker).
+# idempotent should only be True for requests which only read data, their responses are then
+# cached (see response_cache).
+# invalidates: function names whose cached responses are changed by this request.
+def client_post(
+    client, function_name, onglet=None, data=None, idempotent=False, invalidates=[]
+):
+    host = request_layer.host_of_url(getattr(client, "pronote_url", ""))
+    if data is None:
+        fun = lambda: client.post(function_name, onglet)
+    else:
+        fun = lambda: client.post(function_name, onglet, data)
+    call = lambda: request_layer.controlled_call(host, fun, idempotent=idempotent)
+    if not idempotent:
+        try:
+            return call()
+        finally:
+            clear_client_memo(client)
+            if invalidates:
+                response_cache.invalidate(get_cache_scope(client), invalidates)
+    return response_cache.cached_read(
+        get_cache_scope(client), function_name, [onglet, data], call
+    )
+
+
 def get_ent_from_name(ent_name):
     ent = None
     if ent_name:
@@ -160,8 +345,29 @@ def get_ent_from_name(ent_name):
     return ent
 
 
+# Returns a client logged in with the credentials stored for user (the stored token can only be
+# used once), or None.
+def restore_client(session_store_fname, login_url, user, password):
+    credentials = session_store.load_session_data(
+        session_store_fname, login_url, user, password
+    )
+    if credentials is None:
+        return None
+    session_store.forget_session_data(session_store_fname, login_url, user)
+    try:
+        client = pronotepy.Client.token_login(**credentials)
+    except Exception as e:
+        logging.debug(f"Stored session login failed: {e}")
+        return None
+    if not client.logged_in:
+        return None
+    return client
+
+
 # reimplementation
 # Returns a pronotpy.Client object (instead of a request.session object)
+# With session_store_fname, the credentials exported by the client are kept in this file (see
+# session_store), and used to log in with a token at the next run, without going through the ENT.
 def open_session(
     user,
     password,
@@ -171,6 +377,45 @@ def open_session(
     device_name=None,
     account_pin=None,
     ent_name=None,
+    session_store_fname=None,
+):
+    if session_store_fname and (user is None or password is None):
+        print("Warning: user and password are needed to store the session.")
+        session_store_fname = None
+    client = None
+    if session_store_fname:
+        client = restore_client(session_store_fname, login_url, user, password)
+        if client is not None:
+            print("Using stored session")
+    if client is None:
+        client = login_client(
+            user,
+            password,
+            login_url,
+            client_identifier,
+            device_name,
+            account_pin,
+            ent_name,
+        )
+    request_layer.configure_session(client.communication.session)
+    # Connexion success. Saving client identifier to avoid registering again..
+    credentials = client.export_credentials()
+    assert update_config_file_fun
+    update_config_file_fun({"client_identifier": credentials["client_identifier"]})
+    if session_store_fname:
+        session_store.save_session_data(
+            session_store_fname,
+            login_url,
+            user,
+            password,
+            credentials,
+            time.time() + session_store.default_max_age,
+        )
+    return client
+
+
+def login_client(
+    user, password, login_url, client_identifier, device_name, account_pin, ent_name
 ):
     if client_identifier is None:
         if account_pin is None:
@@ -195,10 +440,6 @@ def open_session(
         raise RuntimeError(str(e))
     if not client.logged_in:
         raise RuntimeError("Authentification failure")
-    # Connexion success. Saving client identifier to avoid registering again..
-    credentials = client.export_credentials()
-    assert update_config_file_fun
-    update_config_file_fun({"client_identifier": credentials["client_identifier"]})
     return client
 
 
@@ -209,19 +450,39 @@ def close_session(client):
     pass
 
 
+# The periods and services are asked for several times by each upload. They are kept by client,
+# in memos (dicts) which are cleared by any write (see client_post).
+def get_client_memo(client, name):
+    if not hasattr(client, "lvs_memos"):
+        client.lvs_memos = {}
+    return client.lvs_memos.setdefault(name, {})
+
+
+def clear_client_memo(client):
+    client.lvs_memos = {}
+
+
 # reimplementation
 def request_default_period(client):
-    r = client.post("ListePeriodes", 23)
-    period_data = get_response_data(r, key="periodeParDefaut")
-    return period_data
+    return request_period_from_trimester_nb(client, None)
 
 
+# With trimester_nb None, returns the default period.
 def request_period_from_trimester_nb(client, trimester_nb):
-    r = client.post("ListePeriodes", 23)
-    trimester_key = f"Trimestre {trimester_nb}"
-    period_data = find_in_data(
-        get_response_data(r, key="listePeriodes"), L=trimester_key, exactly_one=True
-    )
+    memo = get_client_memo(client, "periods")
+    if trimester_nb in memo:
+        return memo[trimester_nb]
+    r = client_post(client, "ListePeriodes", 23, idempotent=True)
+    if trimester_nb is None:
+        period_data = get_response_data(r, key="periodeParDefaut")
+    else:
+        trimester_key = f"Trimestre {trimester_nb}"
+        period_data = find_in_data(
+            get_response_data(r, key="listePeriodes"),
+            L=trimester_key,
+            exactly_one=True,
+        )
+    memo[trimester_nb] = period_data
     return period_data
 
 
@@ -232,7 +493,7 @@ def get_user_teacher(client):
 
 # reimplementation
 def get_groups(client):
-    r = client.post("listeClassesGroupes", 23)
+    r = client_post(client, "listeClassesGroupes", 23, idempotent=True)
     group_data_list = get_response_data(r)
     return group_data_list
 
@@ -250,8 +511,13 @@ def request_group_service(client, group_data, period_data=None, teacher_data=Non
         teacher_data = get_user_teacher(client)
     if period_data is None:
         period_data = request_default_period(client)
+    memo = get_client_memo(client, "services")
+    memo_key = (group_data["N"], period_data["N"])
+    if memo_key in memo:
+        return memo[memo_key]
     # Get service for that specific group
-    r = client.post(
+    r = client_post(
+        client,
         "ListeServices",
         23,
         {
@@ -261,10 +527,12 @@ def request_group_service(client, group_data, period_data=None, teacher_data=Non
             "Ressource": group_data,
             "Professeur": filter_dict(teacher_data, ["G", "L", "N"]),
         },
+        idempotent=True,
     )
     service_data = get_response_data(r, "services")
     assert len(service_data) == 1
     service_data = service_data[0]
+    memo[memo_key] = service_data
     return service_data
 
 
@@ -287,7 +555,8 @@ def get_grades(
         service_data = request_group_service(
             client, group_data, period_data=period_data, teacher_data=teacher_data
         )
-    r = client.post(
+    r = client_post(
+        client,
         "PageNotes",
         23,
         {
@@ -295,6 +564,7 @@ def get_grades(
             "ressource": filter_dict(group_data, ["G", "N"]),
             "service": filter_dict(service_data, ["N"]),
         },
+        idempotent=True,
     )
     grades_data = donnees(r)
     return grades_data
@@ -308,7 +578,8 @@ def get_apprs(client, group_data, trimester_nb, period_data=None):
     service_data = request_group_service(
         client, group_data, period_data=period_data, teacher_data=teacher_data
     )
-    r = client.post(
+    r = client_post(
+        client,
         "PageApprBulletin",
         25,
         {
@@ -316,6 +587,7 @@ def get_apprs(client, group_data, trimester_nb, period_data=None):
             "ressource": filter_dict(group_data, ["G", "N"]),
             "service": filter_dict(service_data, ["L", "N"]),
         },
+        idempotent=True,
     )
     apprs_data = donnees(r)
     return apprs_data
@@ -541,10 +813,14 @@ def send_new_grades(
         )
     # Prepare post data
     new_students_data = []
+    name_index = get_name_index(grades_data["listeEleves"]["V"])
     for k in new_grades:
         student_name = k
         student_data = find_in_data(
-            grades_data["listeEleves"]["V"], L=student_name, exactly_one=True
+            grades_data["listeEleves"]["V"],
+            L=student_name,
+            exactly_one=True,
+            name_index=name_index,
         )
         new_grade = new_grades_dict[k]
         new_grade = new_grade.replace(".", ",")
@@ -558,7 +834,9 @@ def send_new_grades(
         "listeDevoirs": [{"N": evaluation_data["N"], "listeEleves": new_students_data}]
     }
     # Do post request
-    r = client.post("SaisieNotesUnitaire", 23, post_data)
+    r = client_post(
+        client, "SaisieNotesUnitaire", 23, post_data, invalidates=["PageNotes"]
+    )
 
 
 # returns a dict of evaluation_name : (col, max_grade, coefficient, evaluation_id)
@@ -595,7 +873,9 @@ def send_grades_dopost(client, trimester, grades_data, group_data, new_grades_di
         new_evaluation_data_list.append(new_evaluation_data)
     post_data = {"listeDevoirs": new_evaluation_data_list}
     # Do post request
-    r = client.post("SaisieNotesUnitaire", 23, post_data)
+    r = client_post(
+        client, "SaisieNotesUnitaire", 23, post_data, invalidates=["PageNotes"]
+    )
 
 
 # reimplementation
@@ -638,7 +918,13 @@ def send_apprs_dopost(
         student_name = student_names[student_id]
         print(f"Uploading {student_name}...")
         # Do post request
-        r = client.post("SaisieAppreciation", 25, post_data)
+        r = client_post(
+            client,
+            "SaisieAppreciation",
+            25,
+            post_data,
+            invalidates=["PageApprBulletin"],
+        )
         from pprint import pprint
 
         if "_messagesErreur_" in str(r):
@@ -658,7 +944,13 @@ def send_apprs_dopost(
             E_value = 2
             appr_data = {"E": E_value, "G": 1, "L": appr, "N": appr_id}
             post_data["appreciation"] = appr_data
-            r = client.post("SaisieAppreciation", 25, post_data)
+            r = client_post(
+                client,
+                "SaisieAppreciation",
+                25,
+                post_data,
+                invalidates=["PageApprBulletin"],
+            )
             if "_messagesErreur_" in str(r):
                 print("Error:")
                 pprint(post_data)
@@ -687,7 +979,7 @@ def get_possible_recipients(client, recipient_types=None):
             "sansFiltreSurEleve": True,
             "avecFonctionPersonnel": True,
         }
-        r = client.post("ListePublics", 131, post_data)
+        r = client_post(client, "ListePublics", 131, post_data, idempotent=True)
         possible_recipient_data_list.extend(get_response_data(r, "listePublics"))
     return possible_recipient_data_list
 
@@ -697,28 +989,36 @@ def get_possible_recipients(client, recipient_types=None):
 # This should be used for a batch of queries, then cleared.
 # reimplementation
 def cache_possible_recipients(client, dest_types=None):
-    global cached_possible_recipient_data_list
+    global cached_possible_recipient_data_list, cached_possible_recipient_name_index
     cached_possible_recipient_data_list = get_possible_recipients(client, dest_types)
+    cached_possible_recipient_name_index = get_name_index(
+        cached_possible_recipient_data_list
+    )
 
 
 # reimplementation
 def clear_possible_recipients_cache():
-    global cached_possible_recipient_data_list
+    global cached_possible_recipient_data_list, cached_possible_recipient_name_index
     cached_possible_recipient_data_list = None
+    cached_possible_recipient_name_index = None
 
 
+# name_index is the index of possible_recipient_data_list (see get_name_index), if the caller
+# built it for several lookups. The names are otherwise compared one by one.
 def find_recipient(
     client,
     recipient_name,
     possible_recipient_data_list=None,
     recipient_type=None,
     recipient_function=None,
+    name_index=None,
     **other_filters,
 ):
     G_of_recipient_type = {"teacher": 3, "staff": 34, "student": 4, "parent": 5}
     if possible_recipient_data_list is None:
         if cached_possible_recipient_data_list:
             possible_recipient_data_list = cached_possible_recipient_data_list
+            name_index = cached_possible_recipient_name_index
         else:
             assert recipient_type
             possible_recipient_data_list = get_possible_recipients(
@@ -726,12 +1026,17 @@ def find_recipient(
             )
     if recipient_type is None:
         raw_l = find_in_data(
-            possible_recipient_data_list, substr=True, L=recipient_name, **other_filters
+            possible_recipient_data_list,
+            substr=True,
+            name_index=name_index,
+            L=recipient_name,
+            **other_filters,
         )
     else:
         raw_l = find_in_data(
             possible_recipient_data_list,
             substr=True,
+            name_index=name_index,
             L=recipient_name,
             G=G_of_recipient_type[recipient_type],
             **other_filters,
@@ -801,7 +1106,7 @@ def new_discussion(
         "contenu": {"_T": 21, "V": message_html},
         "listeDestinataires": recipients_post_data,
     }
-    r_json = client.post("SaisieMessage", 131, post_data)
+    r_json = client_post(client, "SaisieMessage", 131, post_data)
     return r_json
 
 
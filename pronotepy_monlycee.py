@@ -8,6 +8,8 @@ from functools import partial
 
 from pronotepy import ENTLoginError
 
+import request_layer
+
 HEADERS = {
     "User-Agent": "Mozilla/5.0 (X11; Ubuntu; Linux x86_64; rv:73.0) Gecko/20100101 Firefox/73.0"
 }
@@ -50,6 +52,7 @@ def _monlycee_net(
 
     # ENT Connection
     with requests.Session() as session:
+        request_layer.configure_session(session)
         response = session.get(url, headers=HEADERS)
 
         soup = BeautifulSoup(response.text, "html.parser")
@@ -0,0 +1,411 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Control of the requests sent to the websites, shared by the LVS backend (see LvsSession in
+lvs_module) and the pronote backend (see client_post in pronote).
+
+All the requests go through controlled_call, which provides:
+- a global cap on the number of requests in flight;
+- per host rate limiting (token bucket), which slows down when the website is overloaded and
+  speeds up again when it answers;
+- retries with exponential backoff and jitter, only for idempotent requests (reads);
+- a per host circuit breaker, which fails fast when the website keeps failing, instead of sending
+  it more requests.
+
+It also provides the transport (see configure_session), shared by all the sessions of both
+backends, including the ENT login: the connections are kept open and reused by all the sessions
+(and so by all the worker threads), instead of each session paying its own TCP and TLS setup.
+HTTP/2 can be used instead of HTTP/1.1 if httpx is installed.
+"""
+
+import email.message
+import http.cookiejar
+
+import logging
+import os
+import random
+import ssl
+import threading
+import time
+import urllib.parse
+
+import requests
+import requests.adapters
+import requests.cookies
+import requests.structures
+import requests.utils
+
+# Limits, can be changed with set_request_limits.
+max_requests_in_flight = 8
+# Requests per second to a same host, and number of requests that can be sent at once.
+request_rate = 20
+request_burst = 4
+# Under load, the rate of a host is divided by 2 (down to min_request_rate), then goes back up.
+min_request_rate = 1
+# Seconds, as in requests (connect timeout, read timeout).
+request_timeout = (10, 60)
+max_retries = 4
+retry_base_delay = 1  # seconds, doubled at each retry
+# The circuit of a host opens after this many consecutive failures, for circuit_cooldown seconds.
+circuit_failure_threshold = 5
+circuit_cooldown = 60
+
+# HTTP status codes meaning that the website is overloaded or temporarily unavailable.
+overloaded_status_codes = {429, 502, 503, 504}
+# Also retried (for idempotent requests), but the rate is not lowered. Some pages answer 500 on
+# purpose (see module_request in lvs_module), their requests are sent with
+# retry_server_errors=False.
+server_error_status_codes = {500}
+
+# Transport options, can be changed with set_transport_options.
+# Connections kept open per host (default max_requests_in_flight).
+pool_size = None
+use_http2 = False
+
+requests_in_flight = threading.BoundedSemaphore(max_requests_in_flight)
+# dict of host : dict with "rate", "tokens", "update_time", "failures", "open_until"
+host_states = {}
+host_states_lock = threading.Lock()
+shared_adapter = None
+shared_adapter_lock = threading.Lock()
+
+
+class CircuitOpenError(RuntimeError):
+    pass
+
+
+def set_request_limits(
+    max_in_flight=None, rate=None, burst=None, timeout=None, retries=None
+):
+    global max_requests_in_flight, requests_in_flight, request_rate, request_burst
+    global request_timeout, max_retries
+    if max_in_flight is not None:
+        max_requests_in_flight = max_in_flight
+        requests_in_flight = threading.BoundedSemaphore(max_in_flight)
+        reset_shared_adapter()
+    if rate is not None:
+        request_rate = rate
+    if burst is not None:
+        request_burst = burst
+    if timeout is not None:
+        request_timeout = timeout
+    if retries is not None:
+        max_retries = retries
+    with host_states_lock:
+        host_states.clear()
+
+
+def host_of_url(url):
+    return urllib.parse.urlsplit(url).netloc
+
+
+# Must be called with host_states_lock held.
+def get_host_state(host):
+    if not host in host_states:
+        host_states[host] = {
+            "rate": request_rate,
+            "tokens": request_burst,
+            "update_time": time.monotonic(),
+            "failures": 0,
+            "open_until": 0,
+        }
+    return host_states[host]
+
+
+# Waits until a request to host is allowed by its token bucket.
+def take_token(host):
+    while True:
+        with host_states_lock:
+            state = get_host_state(host)
+            now = time.monotonic()
+            state["tokens"] = min(
+                request_burst,
+                state["tokens"] + (now - state["update_time"]) * state["rate"],
+            )
+            state["update_time"] = now
+            if state["tokens"] >= 1:
+                state["tokens"] -= 1
+                return
+            wait = (1 - state["tokens"]) / state["rate"]
+        time.sleep(wait)
+
+
+def check_circuit(host):
+    with host_states_lock:
+        state = get_host_state(host)
+        # After the cooldown, requests are let through again (the next failure reopens it).
+        if time.monotonic() < state["open_until"]:
+            raise CircuitOpenError(
+                f"Too many failed requests to {host}, not sending more for now. Try again later."
+            )
+
+
+def report_success(host):
+    with host_states_lock:
+        state = get_host_state(host)
+        state["failures"] = 0
+        state["rate"] = min(request_rate, state["rate"] + request_rate / 10)
+
+
+def report_failure(host, overloaded):
+    with host_states_lock:
+        state = get_host_state(host)
+        state["failures"] += 1
+        if overloaded:
+            state["rate"] = max(min_request_rate, state["rate"] / 2)
+        if state["failures"] >= circuit_failure_threshold:
+            logging.debug(f"Opening circuit for {host}")
+            state["open_until"] = time.monotonic() + circuit_cooldown
+
+
+def retry_delay(attempt, r=None):
+    # Honor the delay asked by the website, if any (but not longer than a circuit cooldown)
+    if r is not None and r.headers.get("Retry-After", "").isdigit():
+        return min(int(r.headers["Retry-After"]), circuit_cooldown)
+    return retry_base_delay * 2**attempt * random.uniform(0.5, 1.5)
+
+
+# Returns fun(), called when allowed by the limits of host.
+# fun can return a requests.Response (an overloaded status code, or a server error status code if
+# retry_server_errors is True, then counts as a failure) or anything else. Connection errors and
+# timeouts count as failures.
+# Failures are retried only if idempotent is True; the last response is then returned (or the last
+# exception is raised).
+def controlled_call(host, fun, idempotent=False, retry_server_errors=True):
+    failure_status_codes = set(overloaded_status_codes)
+    if retry_server_errors:
+        failure_status_codes |= server_error_status_codes
+    attempts = max_retries + 1 if idempotent else 1
+    for attempt in range(attempts):
+        is_last_attempt = attempt == attempts - 1
+        check_circuit(host)
+        failed = False
+        with requests_in_flight:
+            take_token(host)
+            try:
+                result = fun()
+            except (requests.ConnectionError, requests.Timeout) as e:
+                report_failure(host, overloaded=True)
+                if is_last_attempt:
+                    raise
+                logging.debug(f"Request to {host} failed ({e}), retrying")
+                failed = True
+        if failed:
+            time.sleep(retry_delay(attempt))
+            continue
+        if (
+            isinstance(result, requests.Response)
+            and result.status_code in failure_status_codes
+        ):
+            report_failure(
+                host, overloaded=result.status_code in overloaded_status_codes
+            )
+            if is_last_attempt:
+                return result
+            logging.debug(f"Request to {host} got {result.status_code}, retrying")
+            time.sleep(retry_delay(attempt, result))
+            continue
+        report_success(host)
+        return result
+
+
+## Transport
+
+
+def set_transport_options(size=None, http2=None):
+    global pool_size, use_http2
+    if size is not None:
+        pool_size = size
+    if http2 is not None:
+        use_http2 = http2
+    reset_shared_adapter()
+
+
+def get_pool_size():
+    return pool_size or max_requests_in_flight
+
+
+# Sessions already configured keep the previous adapter.
+def reset_shared_adapter():
+    global shared_adapter
+    with shared_adapter_lock:
+        shared_adapter = None
+
+
+def get_shared_adapter():
+    global shared_adapter
+    with shared_adapter_lock:
+        if shared_adapter is None:
+            if use_http2:
+                shared_adapter = SharedHttp2Adapter()
+            else:
+                shared_adapter = SharedHTTPAdapter()
+        return shared_adapter
+
+
+# Makes session use the shared connections. Can be used on sessions created elsewhere (for example
+# by pronotepy).
+# Compressed responses (gzip, deflate) are asked for and decoded by default, by both adapters.
+def configure_session(session):
+    adapter = get_shared_adapter()
+    session.mount("https://", adapter)
+    session.mount("http://", adapter)
+
+
+# The adapters are shared by all the sessions, so closing a session does not close them: the
+# connections are closed at exit.
+# Requests sent without a timeout (for example by pronotepy) get request_timeout.
+class SharedHTTPAdapter(requests.adapters.HTTPAdapter):
+    def __init__(self):
+        super().__init__(pool_connections=get_pool_size(), pool_maxsize=get_pool_size())
+
+    def send(self, request, timeout=None, **kwargs):
+        if timeout is None:
+            timeout = request_timeout
+        return super().send(request, timeout=timeout, **kwargs)
+
+    def close(self):
+        pass
+
+
+# Same as SharedHTTPAdapter, through httpx clients (which negotiate HTTP/2 with the website).
+# Redirects and cookies are only handled by the requests session: the clients never keep cookies,
+# as they are shared by all the sessions.
+# There is one client for each combination of the verify, cert and proxy settings of the requests
+# (usually a single one).
+class SharedHttp2Adapter(requests.adapters.BaseAdapter):
+    # Not allowed in HTTP/2
+    hop_by_hop_headers = {
+        "connection",
+        "keep-alive",
+        "proxy-connection",
+        "transfer-encoding",
+        "upgrade",
+    }
+
+    def __init__(self):
+        super().__init__()
+        try:
+            import httpx
+        except ImportError:
+            raise RuntimeError(
+                "Module httpx is needed for HTTP/2 (pip install httpx[http2])."
+            )
+        self.httpx = httpx
+        # dict of (verify, cert, proxy) : httpx.Client
+        self.clients = {}
+        self.clients_lock = threading.Lock()
+
+    def get_client(self, verify, cert, proxy):
+        key = (verify, cert, proxy)
+        with self.clients_lock:
+            if not key in self.clients:
+                limits = self.httpx.Limits(
+                    max_connections=get_pool_size(),
+                    max_keepalive_connections=get_pool_size(),
+                )
+                # The environment (proxies, certificates) was already read by requests.
+                self.clients[key] = self.httpx.Client(
+                    http2=True,
+                    limits=limits,
+                    verify=get_ssl_verify(verify, cert),
+                    proxy=proxy,
+                    cookies=http.cookiejar.CookieJar(
+                        policy=http.cookiejar.DefaultCookiePolicy(allowed_domains=[])
+                    ),
+                    trust_env=False,
+                )
+            return self.clients[key]
+
+    def send(
+        self,
+        request,
+        stream=False,
+        timeout=None,
+        verify=True,
+        cert=None,
+        proxies=None,
+    ):
+        httpx = self.httpx
+        if isinstance(cert, list):
+            cert = tuple(cert)
+        client = self.get_client(
+            verify, cert, requests.utils.select_proxy(request.url, proxies)
+        )
+        if timeout is None:
+            timeout = request_timeout
+        if isinstance(timeout, tuple):
+            timeout = httpx.Timeout(timeout[1], connect=timeout[0])
+        headers = {
+            k: v
+            for (k, v) in request.headers.items()
+            if not k.lower() in self.hop_by_hop_headers
+        }
+        try:
+            r = client.request(
+                request.method,
+                request.url,
+                headers=headers,
+                content=request.body,
+                timeout=timeout,
+            )
+        except httpx.TimeoutException as e:
+            raise requests.Timeout(e, request=request)
+        except httpx.TransportError as e:
+            raise requests.ConnectionError(e, request=request)
+        return self.build_response(request, r)
+
+    def build_response(self, request, r):
+        response = requests.Response()
+        response.status_code = r.status_code
+        response.reason = r.reason_phrase
+        response.headers = requests.structures.CaseInsensitiveDict(r.headers)
+        response.encoding = requests.utils.get_encoding_from_headers(response.headers)
+        # Already decoded by httpx
+        response._content = r.content
+        response._content_consumed = True
+        response.url = request.url
+        response.request = request
+        response.connection = self
+        # The cookies are read by requests from raw._original_response.msg, as with urllib3.
+        msg = email.message.Message()
+        for k, v in r.headers.multi_items():
+            msg[k] = v
+        response.raw = HttpxRawResponse(msg)
+        requests.cookies.extract_cookies_to_jar(response.cookies, request, response.raw)
+        return response
+
+    def close(self):
+        pass
+
+
+# Returns the verify argument of httpx.Client for the verify and cert arguments of requests.
+def get_ssl_verify(verify, cert):
+    if cert is None and isinstance(verify, bool):
+        return verify
+    if verify is False:
+        context = ssl.create_default_context()
+        context.check_hostname = False
+        context.verify_mode = ssl.CERT_NONE
+    elif verify is True:
+        context = ssl.create_default_context(
+            cafile=requests.utils.DEFAULT_CA_BUNDLE_PATH
+        )
+    elif os.path.isdir(verify):
+        context = ssl.create_default_context(capath=verify)
+    else:
+        context = ssl.create_default_context(cafile=verify)
+    if isinstance(cert, tuple):
+        context.load_cert_chain(*cert)
+    elif cert:
+        context.load_cert_chain(cert)
+    return context
+
+
+class HttpxRawResponse:
+    def __init__(self, msg):
+        self._original_response = self
+        self.msg = msg
+
+    def close(self):
+        pass
@@ -0,0 +1,127 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Read-through cache of the json responses of the website reads, shared by both backends (see
+cached_read, used by get_groups, get_grades... in lvs_module and by client_post in pronote).
+
+Responses are kept by (scope, endpoint, payload), where the scope identifies the website and
+user, for the ttl of the endpoint (endpoints without a ttl are not cached). They are kept in
+memory, and optionally in a file of the user cache dir, so that the next runs (of any of the
+programs) can use them too.
+The functions which write to the website must call invalidate for the endpoints whose data they
+change.
+"""
+
+import copy
+import hashlib
+import json
+import threading
+import time
+
+import private_file
+
+# Seconds, by endpoint (url name for LVS, function name for pronote). Can be changed with
+# set_cache_options.
+endpoint_ttls = {
+    "get_groups": 3600,
+    "get_grades": 300,
+    "get_apprs": 300,
+    "room": 24 * 3600,
+    "ListePeriodes": 3600,
+    "listeClassesGroupes": 3600,
+    "ListeServices": 3600,
+    "PageNotes": 300,
+    "PageApprBulletin": 300,
+}
+# Full name of the file for the disk tier, None for memory only.
+disk_fname = None
+
+# dict of key : dict with "scope", "endpoint", "expires", "value"
+entries = {}
+disk_loaded = False
+entries_lock = threading.Lock()
+
+
+def set_cache_options(ttls=None, fname=None):
+    global disk_fname, disk_loaded
+    if ttls is not None:
+        endpoint_ttls.update(ttls)
+    if fname is not None:
+        disk_fname = fname
+        disk_loaded = False
+
+
+def get_key(scope, endpoint, payload):
+    s = json.dumps([scope, endpoint, payload], sort_keys=True)
+    return hashlib.sha256(s.encode()).hexdigest()
+
+
+# Must be called with entries_lock held.
+def load_disk():
+    global disk_loaded
+    if disk_fname is None or disk_loaded:
+        return
+    disk_loaded = True
+    try:
+        with open(disk_fname) as f:
+            disk_entries = json.load(f)
+    except FileNotFoundError:
+        return
+    except (json.decoder.JSONDecodeError, PermissionError) as e:
+        print(f"Warning: error reading cache file {disk_fname}:\n  {e}")
+        return
+    for key, entry in disk_entries.items():
+        if not key in entries:
+            entries[key] = entry
+
+
+# Must be called with entries_lock held.
+def write_disk():
+    if disk_fname is None:
+        return
+    now = time.time()
+    for key in [k for (k, e) in entries.items() if e["expires"] <= now]:
+        del entries[key]
+    try:
+        private_file.write_private_json(disk_fname, entries)
+    except PermissionError as e:
+        print(f"Warning: error writing cache file {disk_fname}:\n  {e}")
+
+
+# Returns fetch() (which must return json data), or a copy of its cached value for the same
+# scope, endpoint and payload.
+def cached_read(scope, endpoint, payload, fetch):
+    ttl = endpoint_ttls.get(endpoint)
+    if not ttl:
+        return fetch()
+    key = get_key(scope, endpoint, payload)
+    with entries_lock:
+        load_disk()
+        entry = entries.get(key)
+        if entry is not None and entry["expires"] > time.time():
+            return copy.deepcopy(entry["value"])
+    value = fetch()
+    with entries_lock:
+        entries[key] = {
+            "scope": scope,
+            "endpoint": endpoint,
+            "expires": time.time() + ttl,
+            "value": copy.deepcopy(value),
+        }
+        write_disk()
+    return value
+
+
+# Forgets the cached responses of endpoints for scope (for all payloads).
+def invalidate(scope, endpoints):
+    with entries_lock:
+        load_disk()
+        keys = [
+            k
+            for (k, e) in entries.items()
+            if e["scope"] == scope and e["endpoint"] in endpoints
+        ]
+        for key in keys:
+            del entries[key]
+        if keys:
+            write_disk()
@@ -0,0 +1,105 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Opt-in store of logged in sessions, so that the programs do not need to log in at each run (see
+open_session in lvs_module and in pronote).
+
+The sessions are kept in a json file, each encrypted (AES-GCM) with a key derived from the
+password. The password is thus still needed to use a stored session, but the (slow) login
+requests are skipped.
+Needs pycryptodome, which is installed with pronotepy.
+"""
+
+import base64
+import hashlib
+import json
+import os
+import time
+
+import private_file
+
+# Seconds, for sessions whose expiry is not known.
+default_max_age = 8 * 3600
+kdf_iterations = 200000
+
+
+def get_crypto_aes():
+    try:
+        from Crypto.Cipher import AES
+    except ImportError:
+        raise RuntimeError(
+            "Module pycryptodome is needed to store sessions (pip install pycryptodome)."
+        )
+    return AES
+
+
+# Sessions are stored under a hash of the url and user, so the file does not show them.
+def get_entry_key(url, user):
+    return hashlib.sha256(f"{url}\n{user}".encode()).hexdigest()
+
+
+def derive_key(password, salt):
+    return hashlib.pbkdf2_hmac("sha256", password.encode(), salt, kdf_iterations)
+
+
+def read_store(ffname):
+    try:
+        with open(ffname) as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return {}
+    except (json.decoder.JSONDecodeError, PermissionError) as e:
+        print(f"Warning: error reading session file {ffname}:\n  {e}")
+        return {}
+
+
+def write_store(ffname, store):
+    try:
+        private_file.write_private_json(ffname, store)
+    except PermissionError as e:
+        print(f"Warning: error writing session file {ffname}:\n  {e}")
+
+
+# Returns the data saved by save_session_data, or None if there is none, it has expired or the
+# password does not match.
+def load_session_data(ffname, url, user, password):
+    entry = read_store(ffname).get(get_entry_key(url, user))
+    if entry is None or entry["expires"] <= time.time():
+        return None
+    AES = get_crypto_aes()
+    salt, nonce, tag, ciphertext = [
+        base64.b64decode(entry[k]) for k in ["salt", "nonce", "tag", "data"]
+    ]
+    cipher = AES.new(derive_key(password, salt), AES.MODE_GCM, nonce=nonce)
+    try:
+        data = cipher.decrypt_and_verify(ciphertext, tag)
+    except ValueError:
+        return None
+    return json.loads(data)
+
+
+# data must be json serializable. expires is a time.time() value.
+def save_session_data(ffname, url, user, password, data, expires):
+    AES = get_crypto_aes()
+    salt = os.urandom(16)
+    cipher = AES.new(derive_key(password, salt), AES.MODE_GCM)
+    ciphertext, tag = cipher.encrypt_and_digest(json.dumps(data).encode())
+    entry = {"expires": expires}
+    for k, v in [
+        ("salt", salt),
+        ("nonce", cipher.nonce),
+        ("tag", tag),
+        ("data", ciphertext),
+    ]:
+        entry[k] = base64.b64encode(v).decode()
+    store = read_store(ffname)
+    now = time.time()
+    store = {k: e for (k, e) in store.items() if e["expires"] > now}
+    store[get_entry_key(url, user)] = entry
+    write_store(ffname, store)
+
+
+def forget_session_data(ffname, url, user):
+    store = read_store(ffname)
+    if store.pop(get_entry_key(url, user), None) is not None:
+        write_store(ffname, store)